@@ -1,69 +1,250 @@
-import json
-import argparse
-
-def find_main(prog):
-    for f in prog["functions"]:
-        if f["name"] == "main":
-            return f
-    return None
-
-def load_trace_instrs(trace_prog):
-    f = find_main(trace_prog)
-    return f["instrs"]
-
-def fresh_label(used, base):
-    s = base
-    i = 0
-    while s in used:
-        i+=1
-        s=f"{base}_{i}"
-    used.add(s)
-    return s
-
-def inject_trace(orig, trace):
-    main = find_main(orig)
-    orig_instrs = main["instrs"]
-
-    used_labels = {i["label"] for i in orig_instrs if "label" in i}
-    used_labels.add("__trace_fail")
-    fast_label = fresh_label(used_labels,"__fast")
-
-    new = []
-    new.append({"label": fast_label})
-    new.append({"op":"speculate"})
-    new.append({"op":"guard","args":[True],"labels":["__trace_fail"]})
-
-    for ins in trace[:-1]:
-        new.append(ins)
-
-    new.append({"op":"commit"})
-    new.append(trace[-1])
-
-    new.append({"label":"__trace_fail"})
-    new.extend(orig_instrs)
-
-    main["instrs"] = new
-    return orig
-
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("orig")
-    ap.add_argument("trace")
-    ap.add_argument("-o","--out",default="gpf_opt.json")
-    args = ap.parse_args()
-
-    with open(args.orig) as f:
-        orig=json.load(f)
-    with open(args.trace) as f:
-        trace=json.load(f)
-
-    trace_instrs = load_trace_instrs(trace)
-    new_prog = inject_trace(orig, trace_instrs)
-
-    with open(args.out,"w") as f:
-        json.dump(new_prog,f,indent=2)
-
-    print("optimized program written to",args.out)
-
-if __name__=="__main__":
-    main()
+import json
+import argparse
+
+def find_main(prog):
+    for f in prog["functions"]:
+        if f["name"] == "main":
+            return f
+    return None
+
+def load_trace_instrs(trace_prog):
+    f = find_main(trace_prog)
+    return f["instrs"]
+
+def read_traces(path):
+    """Load the traces written by tracer.py. Returns a list of
+    (metadata, instructions) pairs. A whole-program trace has None for
+    metadata; a hot-loop trace has {"function", "header"}, and the
+    profile figures of `loop_trace_gain` if the tracer wrote them.
+
+    Reads JSON, either a whole program or a {"traces": [...]} object of
+    loop traces, and JSON Lines, where each {"trace": ...} line starts
+    the next loop trace.
+    """
+    with open(path) as f:
+        if not path.endswith(".jsonl"):
+            data = json.load(f)
+            if "traces" not in data:
+                return [(None, load_trace_instrs(data))]
+            return [
+                ({k: v for k, v in t.items() if k != "instrs"}, t["instrs"])
+                for t in data["traces"]
+            ]
+        traces = []
+        instrs = None
+        for line in f:
+            if not line.strip():
+                continue
+            ins = json.loads(line)
+            if "trace" in ins:
+                instrs = []
+                traces.append((ins["trace"], instrs))
+            else:
+                if instrs is None:
+                    instrs = []
+                    traces.append((None, instrs))
+                instrs.append(ins)
+        return traces
+
+def fresh_label(used, base):
+    s = base
+    i = 0
+    while s in used:
+        i+=1
+        s=f"{base}_{i}"
+    used.add(s)
+    return s
+
+def find_function(prog, name):
+    for f in prog["functions"]:
+        if f["name"] == name:
+            return f
+    raise SystemExit(f"no function @{name} to inject a trace into")
+
+def var_types(func, trace):
+    """Types of the variables of a function and a trace for it, so that
+    copies of them can be declared.
+    """
+    types = {a["name"]: a["type"] for a in func.get("args", [])}
+    for ins in list(func["instrs"]) + list(trace):
+        if "dest" in ins and "type" in ins:
+            types.setdefault(ins["dest"], ins["type"])
+    return types
+
+def defer_prints(func, trace):
+    """Split the prints off a trace, so they can run after it commits.
+
+    A failed guard rolls back variables but not output, and the code it
+    falls back to prints again. So inside the speculative region each
+    print is replaced by copies of its arguments into fresh variables,
+    and the prints of those are returned to go after the `commit`.
+    Printing is all a trace can do besides setting variables, so moving
+    the prints to the end of it does not change what is printed.
+    Returns (instructions, prints).
+    """
+    types = var_types(func, trace)
+    used = set(types)
+    for ins in func["instrs"]:
+        used.update(ins.get("args", []))
+    n = 0
+    body = []
+    prints = []
+    for ins in trace:
+        if ins.get("op") != "print":
+            body.append(ins)
+            continue
+        saved = []
+        for a in ins.get("args", []):
+            while f"__out{n}" in used:
+                n += 1
+            name = f"__out{n}"
+            used.add(name)
+            body.append({"dest": name, "op": "id", "type": types[a], "args": [a]})
+            saved.append(name)
+        prints.append(dict(ins, args=saved))
+    return body, prints
+
+def inject_trace(orig, trace):
+    main = find_main(orig)
+    orig_instrs = main["instrs"]
+
+    used_labels = {i["label"] for i in orig_instrs if "label" in i}
+    used_labels.add("__trace_fail")
+    fast_label = fresh_label(used_labels,"__fast")
+
+    # The trace starts by setting main's parameters to the values it was
+    # recorded with. Leave them out so the guards check the real inputs.
+    params = {a["name"] for a in main.get("args", [])}
+    start = 0
+    while (start < len(trace) - 1 and trace[start].get("op") == "const"
+           and trace[start].get("dest") in params):
+        start += 1
+
+    # The fast path has to end the program: falling through would run
+    # the original code as well. A trace of a `main` that ran off its
+    # end has no `ret` of its own.
+    end = len(trace)
+    ret = {"op":"ret"}
+    if end > start and trace[-1].get("op") == "ret":
+        end -= 1
+        ret = trace[-1]
+    body, prints = defer_prints(main, trace[start:end])
+
+    new = []
+    new.append({"label": fast_label})
+    new.append({"op":"speculate"})
+    new.extend(body)
+    new.append({"op":"commit"})
+    new.extend(prints)
+    new.append(ret)
+
+    new.append({"label":"__trace_fail"})
+    new.extend(orig_instrs)
+
+    main["instrs"] = new
+    return orig
+
+def retarget(ins, label):
+    if ins.get("op") == "guard":
+        return dict(ins, labels=[label])
+    return ins
+
+def inject_loop_trace(func, header, trace):
+    """Splice one iteration of a hot loop in at the loop's header.
+
+    The header now speculatively runs the trace, commits, prints what
+    the iteration printed and goes round again. If a guard fails, the
+    iteration's effects are rolled back and control falls through to
+    the original header code, which also takes care of leaving the loop.
+    """
+    instrs = func["instrs"]
+    used_labels = {i["label"] for i in instrs if "label" in i}
+    if header not in used_labels:
+        raise SystemExit(f"no label .{header} in @{func['name']}")
+    at = next(i for i, ins in enumerate(instrs) if ins.get("label") == header)
+    slow = fresh_label(used_labels, header + "__slow")
+
+    body, prints = defer_prints(func, trace)
+
+    new = instrs[:at + 1]
+    new.append({"op":"speculate"})
+    new.extend(retarget(ins, slow) for ins in body)
+    new.append({"op":"commit"})
+    new.extend(prints)
+    new.append({"op":"jmp","labels":[header]})
+    new.append({"label": slow})
+    new.extend(instrs[at + 1:])
+    func["instrs"] = new
+
+def loop_trace_gain(meta, trace):
+    """Estimate how many dynamic instructions injecting a loop trace
+    would have saved on the run it was recorded from, or None if the
+    tracer left no profile figures in `meta`.
+
+    An iteration that stays on the trace runs the trace, its deferred
+    prints, speculate, commit and the jump back, instead of the "cost"
+    of the original iteration. Every other run of the header, at least
+    the one that leaves the loop, pays for speculate and, at worst, the
+    whole trace before a guard fails and the original code runs anyway.
+    """
+    if not all(k in meta for k in ("cost", "runs", "completions")):
+        return None
+    size = len(trace) + sum(len(ins.get("args", [])) for ins in trace
+                            if ins.get("op") == "print")
+    stays = meta["completions"]
+    leaves = meta["runs"] - stays
+    return stays * (meta["cost"] - size - 3) - leaves * (size + 1)
+
+def inject_loop_traces(orig, traces, force=False):
+    """Inject any number of hot-loop traces, each into its own function
+    at its own header. Unless `force` is set, a trace is only injected
+    if `loop_trace_gain` says it pays for itself: the speculate, guard
+    and commit overhead is easily more than a short loop body saves.
+    """
+    seen = set()
+    for meta, trace in traces:
+        key = (meta["function"], meta["header"])
+        if key in seen or not trace:
+            continue
+        seen.add(key)
+        where = f"@{meta['function']} .{meta['header']}"
+        gain = loop_trace_gain(meta, trace)
+        if not force:
+            if gain is None:
+                print(f"{where}: not injected, the trace has no profile")
+                continue
+            if gain <= 0:
+                print(f"{where}: not injected, estimated {-gain} more instructions")
+                continue
+        if gain is not None:
+            print(f"{where}: injected, estimated {gain} fewer instructions")
+        inject_loop_trace(find_function(orig, meta["function"]), meta["header"], trace)
+    return orig
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("orig")
+    ap.add_argument("trace", nargs="+")
+    ap.add_argument("-o","--out",default="gpf_opt.json")
+    ap.add_argument("--force", action="store_true",
+                    help="inject every loop trace, even ones the profile says do not pay off")
+    args = ap.parse_args()
+
+    with open(args.orig) as f:
+        orig=json.load(f)
+    traces = [t for path in args.trace for t in read_traces(path)]
+    whole = [instrs for meta, instrs in traces if meta is None]
+    if whole:
+        if len(traces) > 1:
+            raise SystemExit("a whole-program trace cannot be combined with other traces")
+        new_prog = inject_trace(orig, whole[0])
+    else:
+        new_prog = inject_loop_traces(orig, traces, args.force)
+
+    with open(args.out,"w") as f:
+        json.dump(new_prog,f,indent=2)
+
+    print("optimized program written to",args.out)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,211 @@
+import json
+import argparse
+
+from fold import COMMUTATIVE, FOLD, IDENTITY
+from injector import find_main, find_function, read_traces
+
+# Ops that are kept whether or not anything reads their result.
+EFFECTS = {"print", "guard", "ret", "call", "speculate", "commit"}
+
+TERMINATORS = {"jmp", "br", "ret"}
+
+def live_at(func, label):
+    """The variables live on entry to `label` in a function, found by
+    solving liveness over its basic blocks.
+    """
+    blocks = []
+    index = {}
+    for ins in func["instrs"]:
+        if "label" in ins:
+            index[ins["label"]] = len(blocks)
+            blocks.append([])
+        else:
+            if not blocks or (blocks[-1] and blocks[-1][-1]["op"] in TERMINATORS):
+                blocks.append([])
+            blocks[-1].append(ins)
+
+    succs = []
+    for i, block in enumerate(blocks):
+        last = block[-1] if block else {}
+        if last.get("op") in ("jmp", "br"):
+            succs.append([index[l] for l in last["labels"]])
+        elif last.get("op") == "ret" or i + 1 == len(blocks):
+            succs.append([])
+        else:
+            succs.append([i + 1])
+
+    live_in = [set() for _ in blocks]
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(range(len(blocks))):
+            live = set()
+            for s in succs[i]:
+                live |= live_in[s]
+            for ins in reversed(blocks[i]):
+                live.discard(ins.get("dest"))
+                live.update(ins.get("args", []))
+            if live != live_in[i]:
+                live_in[i] = live
+                changed = True
+    return live_in[index[label]]
+
+def lvn(trace, opaque=()):
+    """Local value numbering over a straight-line trace, with copy
+    propagation and constant folding. A recomputed value becomes a copy
+    of a variable that still holds it, arguments are renamed to the
+    oldest such variable, and guards on a known true condition are
+    dropped. Consts that define a name in `opaque` are not treated as
+    constants.
+    """
+    table = {}  # Value -> number.
+    consts = {}  # Number -> constant value.
+    var2num = {}
+    holders = {}  # Number -> variables holding it, oldest first.
+
+    def fresh():
+        n = len(holders)
+        holders[n] = []
+        return n
+
+    def number(var):
+        n = var2num.get(var)
+        if n is None:
+            # Defined before the trace starts.
+            n = var2num[var] = fresh()
+            holders[n].append(var)
+        return n
+
+    def assign(var, n):
+        old = var2num.get(var)
+        if old is not None:
+            holders[old].remove(var)
+        var2num[var] = n
+        holders[n].append(var)
+
+    def copy(ins, n):
+        return {"dest": ins["dest"], "op": "id", "type": ins["type"], "args": [holders[n][0]]}
+
+    out = []
+    for ins in trace:
+        op = ins.get("op")
+        nums = [number(a) for a in ins.get("args", [])]
+        if nums:
+            ins = dict(ins, args=[holders[n][0] for n in nums])
+
+        if op == "guard" and consts.get(nums[0]) is True:
+            continue
+        if "dest" not in ins:
+            out.append(ins)
+            continue
+        if op in EFFECTS:
+            out.append(ins)
+            assign(ins["dest"], fresh())
+            continue
+
+        vals = [consts.get(n) for n in nums]
+        value = None
+        if op == "id":
+            n = nums[0]
+            if var2num.get(ins["dest"]) != n:
+                assign(ins["dest"], n)
+                out.append(ins)
+            continue
+        if op == "const":
+            if ins["dest"] not in opaque:
+                value = ("const", ins["type"], ins["value"])
+        elif op in FOLD and nums and None not in vals and not (op == "div" and vals[1] == 0):
+            folded = FOLD[op](*vals)
+            ins = {"dest": ins["dest"], "op": "const", "type": ins["type"], "value": folded}
+            value = ("const", ins["type"], folded)
+        elif op in IDENTITY and len(nums) == 2 and vals[1] is not None and vals[1] == IDENTITY[op]:
+            value = nums[0]
+        elif op in IDENTITY and op in COMMUTATIVE and vals[0] is not None and vals[0] == IDENTITY[op]:
+            value = nums[1]
+        else:
+            args = sorted(nums) if op in COMMUTATIVE else nums
+            value = (op, ins["type"], tuple(args))
+
+        if isinstance(value, int):
+            n = value  # A copy of an argument.
+        else:
+            n = table.get(value) if value is not None else None
+        if var2num.get(ins["dest"]) == n is not None:
+            continue  # Already holds the value.
+        if n is None:
+            n = fresh()
+            if value is not None:
+                table[value] = n
+                if value[0] == "const":
+                    consts[n] = value[2]
+        elif holders[n]:
+            ins = copy(ins, n)
+        assign(ins["dest"], n)
+        out.append(ins)
+    return out
+
+def dce(trace, live_out=()):
+    """Drop instructions whose results nobody reads, in one backward
+    pass. `live_out` are the variables read after the trace.
+    """
+    live = set(live_out)
+    kept = []
+    for ins in reversed(trace):
+        dest = ins.get("dest")
+        if dest is not None:
+            if ins["op"] not in EFFECTS and dest not in live:
+                continue
+            live.discard(dest)
+        live.update(ins.get("args", []))
+        kept.append(ins)
+    return kept[::-1]
+
+def optimize(trace, live_out=(), opaque=()):
+    return dce(lvn(trace, opaque), live_out)
+
+def write_traces(f, traces, jsonl=False):
+    """Write traces in the format `read_traces` reads."""
+    if jsonl:
+        for meta, instrs in traces:
+            if meta is not None:
+                f.write(json.dumps({"trace": meta}) + "\n")
+            for ins in instrs:
+                f.write(json.dumps(ins) + "\n")
+    elif len(traces) == 1 and traces[0][0] is None:
+        json.dump({"functions": [
+            {"name": "main", "args": [], "instrs": traces[0][1]}
+        ]}, f, indent=2)
+    else:
+        json.dump({"traces": [
+            dict(meta, instrs=instrs) for meta, instrs in traces
+        ]}, f, indent=2)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("orig")
+    ap.add_argument("trace")
+    ap.add_argument("-o","--out",default="Trace_opt.json")
+    args = ap.parse_args()
+
+    with open(args.orig) as f:
+        orig=json.load(f)
+
+    out = []
+    for meta, instrs in read_traces(args.trace):
+        if meta is None:
+            # main's parameters are recorded as consts of the traced
+            # inputs; folding them would bake those inputs in.
+            params = {a["name"] for a in find_main(orig).get("args", [])}
+            new = optimize(instrs, opaque=params)
+        else:
+            func = find_function(orig, meta["function"])
+            new = optimize(instrs, live_at(func, meta["header"]))
+        out.append((meta, new))
+        where = "main" if meta is None else f"@{meta['function']} .{meta['header']}"
+        print(f"{where}: {len(instrs)} -> {len(new)} instructions")
+
+    with open(args.out,"w") as f:
+        write_traces(f, out, args.out.endswith(".jsonl"))
+
+if __name__=="__main__":
+    main()
@@ -1,154 +1,750 @@
-import json
-import copy
-import argparse
-
-SUPPORTED_OPS = {
-    "const", "add", "sub", "mul", "div",
-    "eq", "lt", "gt", "le", "ge",
-    "and", "or", "not",
-    "print",
-    "jmp", "br", "call", "ret"
-}
-
-def eval_op(op, vals):
-    if op == "add": return vals[0] + vals[1]
-    if op == "sub": return vals[0] - vals[1]
-    if op == "mul": return vals[0] * vals[1]
-    if op == "div": return vals[0] // vals[1]
-    if op == "eq": return vals[0] == vals[1]
-    if op == "lt": return vals[0] < vals[1]
-    if op == "gt": return vals[0] > vals[1]
-    if op == "le": return vals[0] <= vals[1]
-    if op == "ge": return vals[0] >= vals[1]
-    if op == "and": return vals[0] and vals[1]
-    if op == "or": return vals[0] or vals[1]
-    if op == "not": return not vals[0]
-    raise RuntimeError(op)
-
-def run_function(fn, func_table, args_vals):
-    instrs = fn["instrs"]
-    labels = {ins.get("label"): i for i, ins in enumerate(instrs) if "label" in ins}
-    params = fn.get("args", [])
-    env = {}
-    for p, v in zip(params, args_vals):
-        env[p["name"]] = v
-
-    trace = []
-    dyn = 0
-    pc = 0
-
-    while pc < len(instrs):
-        ins = instrs[pc]
-        if "label" in ins:
-            pc += 1
-            continue
-        op = ins["op"]
-        dyn += 1
-        if op not in ("jmp","br","call"):
-            trace.append(copy.deepcopy(ins))
-        if op == "const":
-            env[ins["dest"]] = ins["value"]
-            pc += 1
-        elif op in ("add","sub","mul","div","eq","lt","gt","le","ge","and","or","not"):
-            vals = [env[a] for a in ins.get("args",[])]
-            env[ins["dest"]] = eval_op(op, vals)
-            pc += 1
-        elif op == "print":
-            vals = [env[a] for a in ins.get("args",[])]
-            print(*vals)
-            pc += 1
-        elif op == "jmp":
-            pc = labels[ins["labels"][0]]
-        elif op == "br":
-            cond = env[ins["args"][0]]
-            tgt = ins["labels"][0] if cond else ins["labels"][1]
-            pc = labels[tgt]
-        elif op == "call":
-            callee = func_table[ins["funcs"][0]]
-            arg_names = ins.get("args",[])
-            arg_vals = [env[a] for a in arg_names]
-            ret_val, sub_trace, sub_dyn = run_function(callee, func_table, arg_vals)
-            dyn += sub_dyn
-            param_list = callee.get("args",[])
-            init_list = []
-            for p,v in zip(param_list,arg_vals):
-                init_list.append({
-                    "dest": p["name"],
-                    "op":"const",
-                    "type": p["type"],
-                    "value": v
-                })
-            clean_sub = [t for t in sub_trace if t.get("op")!="ret"]
-            trace.extend(init_list)
-            trace.extend(clean_sub)
-            if "dest" in ins:
-                env[ins["dest"]] = ret_val
-                trace.append({
-                    "dest": ins["dest"],
-                    "op":"const",
-                    "type": ins["type"],
-                    "value": ret_val
-                })
-            pc += 1
-        elif op == "ret":
-            args = ins.get("args",[])
-            rv = env[args[0]] if args else None
-            return rv, trace, dyn
-
-    return None, trace, dyn
-
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("prog")
-    ap.add_argument("--arg", action="append", default=[])
-    args = ap.parse_args()
-    with open(args.prog) as f:
-        prog = json.load(f)
-    func_table = {fn["name"]:fn for fn in prog["functions"]}
-
-    arg_dict = {}
-    for a in args.arg:
-        n,v = a.split("=")
-        arg_dict[n]=int(v)
-
-    main_fn = func_table["main"]
-    params = main_fn.get("args",[])
-    main_args = []
-    for p in params:
-        main_args.append(arg_dict.get(p["name"],0))
-
-    ret, trace, dyn = run_function(main_fn, func_table, main_args)
-    print(f"total_dyn_inst: {dyn}")
-
-    if trace[-1]["op"]=="ret":
-        if "args" not in trace[-1] or trace[-1]["args"]==[]:
-            for ins in reversed(trace[:-1]):
-                if "dest" in ins:
-                    trace[-1]["args"]=[ins["dest"]]
-                    break
-
-    init_list = []
-    for p,v in zip(params, main_args):
-        init_list.append({
-            "dest": p["name"],
-            "op":"const",
-            "type": p["type"],
-            "value": v
-        })
-
-    out = {
-        "functions":[
-            {
-                "name":"main",
-                "args":[],
-                "instrs": init_list + trace
-            }
-        ]
-    }
-
-    with open("Trace.json","w") as f:
-        json.dump(out,f,indent=2)
-    print("Trace generated.")
-
-if __name__=="__main__":
-    main()
+import json
+import argparse
+import operator
+from array import array
+
+SUPPORTED_OPS = {
+    "const", "add", "sub", "mul", "div",
+    "eq", "lt", "gt", "le", "ge",
+    "and", "or", "not", "id",
+    "print",
+    "jmp", "br", "call", "ret"
+}
+
+BINARY_OPS = {
+    "add": operator.add,
+    "sub": operator.sub,
+    "mul": operator.mul,
+    "div": operator.floordiv,
+    "eq": operator.eq,
+    "lt": operator.lt,
+    "gt": operator.gt,
+    "le": operator.le,
+    "ge": operator.ge,
+    "and": lambda a, b: a and b,
+    "or": lambda a, b: a or b,
+}
+
+TERMINATORS = ("jmp", "br", "ret")
+
+# Kinds of compiled instructions the dispatch loop tells apart.
+STEP, BR, CALL, RET = range(4)
+
+# Guards in a trace jump here when they fail; the injector points them
+# at the code to fall back to.
+FAIL_LABEL = "__trace_fail"
+
+class StaticTable:
+    """Every instruction that can appear in a trace, by integer id.
+
+    Besides the program's own instructions there are the ones the tracer
+    synthesizes: copies that pass arguments into and results out of an
+    inlined call, guards that stand in for branches, and copies of
+    instructions with their variables renamed for an inlined frame.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.copies = {}
+        self.renames = {}
+
+    def add(self, ins):
+        self.entries.append(ins)
+        return len(self.entries) - 1
+
+    def copy(self, dest, typ, src):
+        """The id of `dest: typ = id src`, made on first use."""
+        key = (dest, typ, src)
+        sid = self.copies.get(key)
+        if sid is None:
+            sid = self.copies[key] = self.add({"dest": dest, "op": "id", "type": typ, "args": [src]})
+        return sid
+
+    def renamed(self, sid, depth):
+        """The id of instruction `sid` as run `depth` calls deep in an
+        inlined trace, with its variables renamed by `local`.
+        """
+        key = (sid, depth)
+        rid = self.renames.get(key)
+        if rid is None:
+            ins = dict(self.entries[sid])
+            if "dest" in ins:
+                ins["dest"] = local(ins["dest"], depth)
+            if "args" in ins:
+                ins["args"] = [local(a, depth) for a in ins["args"]]
+            rid = self.renames[key] = self.add(ins)
+        return rid
+
+    def guards(self, cond):
+        """Templates for the checks that a branch on `cond` went the way
+        it did in the trace: a guard for the true side, and a negation
+        and guard for the false side.
+        """
+        neg = cond + ".not"
+        taken = self.add({"op": "guard", "args": [cond], "labels": [FAIL_LABEL]})
+        negate = self.add({"dest": neg, "op": "not", "type": "bool", "args": [cond]})
+        not_taken = self.add({"op": "guard", "args": [neg], "labels": [FAIL_LABEL]})
+        return taken, negate, not_taken
+
+def local(name, depth):
+    """A variable's name in a trace, for a frame `depth` calls below the
+    one recording started in. Each inlined frame gets its own names, so
+    a callee cannot clobber its caller's variables; frames at the same
+    depth are never live at once, so they can share them.
+    """
+    return name if depth <= 0 else "{}__{}".format(name, depth)
+
+class TraceSink:
+    """Where the interpreter sends executed instructions, as static ids.
+
+    A sink stops accepting records once it holds `limit` of them (if a
+    limit is set) and sets `truncated`. Recording can also be paused and
+    resumed, which hot-loop selection uses to capture a single region.
+
+    `depth` is the call depth the interpreter is at and `base` the depth
+    recording started at. Instructions recorded deeper than `base` come
+    from inlined calls and are renamed to that frame's variables.
+    """
+
+    def __init__(self, table, limit=None, recording=True):
+        self.table = table
+        self.limit = limit
+        self.recording = recording
+        self.truncated = False
+        self.count = 0
+        self.depth = 0
+        self.base = 0
+
+    def record(self, sid):
+        if self.recording:
+            if self.depth > self.base:
+                sid = self.table.renamed(sid, self.depth - self.base)
+            self.emit(sid)
+            self.tick()
+
+    def record_copy(self, dest, dest_depth, typ, src, src_depth):
+        """Record `dest = id src` between two frames, at depths relative
+        to where recording started.
+        """
+        if self.recording:
+            self.emit(self.table.copy(local(dest, dest_depth), typ, local(src, src_depth)))
+            self.tick()
+
+    def tick(self):
+        self.count += 1
+        if self.limit is not None and self.count >= self.limit:
+            self.recording = False
+            self.truncated = True
+
+    def __len__(self):
+        return self.count
+
+class TraceBuffer(TraceSink):
+    """A dynamic trace kept as an array of static ids. Instruction dicts
+    are only looked up by `instrs` when the trace is written out.
+    """
+
+    def __init__(self, table, limit=None, recording=True):
+        super().__init__(table, limit, recording)
+        self.sids = array("i")
+
+    def emit(self, sid):
+        self.sids.append(sid)
+
+    def clear(self):
+        del self.sids[:]
+        self.count = 0
+        self.truncated = False
+
+    def take(self):
+        """Move what has been recorded into a new buffer, leaving this
+        one empty.
+        """
+        out = TraceBuffer(self.table, self.limit, recording=False)
+        out.sids, out.count = self.sids, self.count
+        self.sids = array("i")
+        self.clear()
+        return out
+
+    def instrs(self):
+        """Materialize the trace as Bril instructions, one at a time."""
+        entries = self.table.entries
+        for sid in self.sids:
+            yield entries[sid]
+
+class JsonLinesSink(TraceSink):
+    """Write a trace to a file as it is recorded, one JSON instruction
+    per line, so memory use does not grow with the trace. A trailing
+    bare `ret` is completed on the fly like `final_ret` does.
+    """
+
+    def __init__(self, f, table, limit=None, recording=True):
+        super().__init__(table, limit, recording)
+        self.f = f
+        self.encoded = {}
+        self.last_dest = None
+
+    def write(self, ins):
+        self.f.write(json.dumps(ins))
+        self.f.write("\n")
+
+    def emit(self, sid):
+        ins = self.table.entries[sid]
+        if ins["op"] == "ret" and not ins.get("args") and self.last_dest is not None:
+            self.write(dict(ins, args=[self.last_dest]))
+            return
+        if "dest" in ins:
+            self.last_dest = ins["dest"]
+        text = self.encoded.get(sid)
+        if text is None:
+            text = self.encoded[sid] = json.dumps(ins) + "\n"
+        self.f.write(text)
+
+class HotLoop:
+    """Select hot loops and record one iteration of each.
+
+    Every taken back edge (a jump to the same or an earlier instruction)
+    bumps a counter for its target, the loop header. When a counter
+    reaches `threshold`, recording starts at the header and stops when
+    the same call frame comes back to it. The iteration goes into
+    `traces` and selection carries on, until `limit` loops are traced.
+
+    If the frame returns first, the partial trace is thrown away and
+    selection starts over. A loop whose iteration makes a call, or does
+    not fit in the trace's length limit, is given up on, so a loop trace
+    only ever holds code from the function it is injected into.
+
+    The instructions each traced iteration ran are kept too, so that
+    `stats` can tell, once the run is over, how often the loop went
+    round and what an iteration cost.
+    """
+
+    def __init__(self, threshold, trace, limit=1):
+        self.threshold = threshold
+        self.trace = trace
+        self.limit = limit
+        self.counts = {}
+        self.frame = None
+        self.done = set()  # Headers traced or given up on.
+        self.traces = []  # (function name, header label, TraceBuffer)
+        # (function name, header label) -> (header pc, {pc: times run}).
+        self.iterations = {}
+
+    def back_edge(self, cfn, pc, regs):
+        if self.frame is not None:
+            if regs is self.frame and pc == self.key[1]:
+                if self.trace.truncated:
+                    self.give_up()
+                else:
+                    label = cfn.label_at[pc]
+                    ran = {i: n - m for i, (n, m) in enumerate(zip(cfn.hits, self.start))
+                           if n != m}
+                    self.iterations[(cfn.name, label)] = (pc, ran)
+                    self.traces.append((cfn.name, label, self.trace.take()))
+                    self.done.add(self.key)
+                    self.stop()
+            return
+        if len(self.traces) >= self.limit:
+            return
+
+        key = (cfn.name, pc)
+        if key in self.done:
+            return
+        n = self.counts.get(key, 0) + 1
+        self.counts[key] = n
+        if n >= self.threshold:
+            self.frame = regs
+            self.key = key
+            self.start = list(cfn.hits)
+            self.trace.base = self.trace.depth
+            self.trace.recording = True
+
+    def stats(self, func_table):
+        """Profile figures for each traced loop, by (function name,
+        header label), from the counts at the end of the run: "cost",
+        the instructions the traced iteration ran; "runs", how often the
+        header ran; and "completions", an upper bound on how many
+        iterations ran the same instructions as the traced one.
+        """
+        out = {}
+        for key, (pc, ran) in self.iterations.items():
+            hits = func_table[key[0]].hits
+            out[key] = {
+                "cost": sum(ran.values()),
+                "runs": hits[pc],
+                "completions": min(hits[i] // n for i, n in ran.items()),
+            }
+        return out
+
+    def stop(self):
+        self.frame = None
+        self.trace.recording = False
+        self.trace.clear()
+
+    def give_up(self):
+        self.done.add(self.key)
+        self.stop()
+
+    def call(self, regs):
+        if regs is self.frame:
+            self.give_up()
+
+    def leave(self, regs):
+        if regs is self.frame:
+            self.stop()
+            self.counts.clear()
+
+class CompiledFunction:
+    """A Bril function lowered once into a flat list of closures.
+
+    Variables are resolved to register slots and labels to code indices,
+    so running an instruction is one call that updates the register list
+    and returns the next pc. Calls and returns are left to the dispatch
+    loop. Each entry of `code` is (kind, closure or operands, static id
+    of the instruction). Jumps are not recorded in the trace and have
+    None in place of the id; branches are recorded as guards on their
+    condition and carry the guard templates among their operands.
+
+    Running the function keeps a profile: `hits` counts executions of
+    each instruction, `taken` how often each branch went to its true
+    side, and `calls` how often the function was entered. Block and edge
+    counts are worked out from these by `profile`.
+    """
+
+    def __init__(self, fn, table):
+        self.fn = fn
+        self.name = fn["name"]
+        self.table = table
+        self.slots = {}
+        self.params = [self.slot(p["name"]) for p in fn.get("args", [])]
+        self.signature = [(p["name"], p["type"]) for p in fn.get("args", [])]
+
+        # Labels point at the next real instruction.
+        labels = {}
+        self.label_at = {}
+        body = []
+        for ins in fn["instrs"]:
+            if "label" in ins:
+                labels[ins["label"]] = len(body)
+                self.label_at.setdefault(len(body), ins["label"])
+            else:
+                body.append(ins)
+        self.body = body
+        self.code = [self.lower(ins, pc, labels) for pc, ins in enumerate(body)]
+        self.nslots = len(self.slots)
+        self.blocks = self.find_blocks(fn["instrs"])
+
+        # Plain lists: bumping an item of an `array` boxes and unboxes
+        # the count, which costs more than the list's int objects.
+        self.hits = [0] * len(body)
+        self.taken = [0] * len(body)
+        self.calls = 0
+
+    def find_blocks(self, instrs):
+        """Split the function into basic blocks as (name, start pc, end
+        pc), named the way `cfg.block_map(form_blocks(...))` names them.
+        """
+        ranges = []
+        label, start, size = None, 0, 0
+        pc = 0
+        for ins in instrs:
+            if "label" in ins:
+                if label is not None or size:
+                    ranges.append((label, start, pc))
+                label, start, size = ins["label"], pc, 0
+            else:
+                pc += 1
+                size += 1
+                if ins["op"] in TERMINATORS:
+                    ranges.append((label, start, pc))
+                    label, start, size = None, pc, 0
+        if label is not None or size:
+            ranges.append((label, start, pc))
+
+        blocks = []
+        names = set()
+        for label, start, end in ranges:
+            if label is None:
+                i = 1
+                while f"b{i}" in names:
+                    i += 1
+                label = f"b{i}"
+            names.add(label)
+            blocks.append((label, start, end))
+        return blocks
+
+    def profile(self):
+        """Execution counts per block and per CFG edge, as
+        ({block: count}, {block: {successor: count}}). Every edge of the
+        CFG is listed, including ones never taken.
+        """
+        counts = {}
+        edges = {}
+        for i, (name, start, end) in enumerate(self.blocks):
+            nxt = self.blocks[i + 1][0] if i + 1 < len(self.blocks) else None
+            out = edges[name] = {}
+            if start == end:
+                # A bare label: entered as often as edges lead into it,
+                # which only come from blocks already seen or by a jump.
+                counts[name] = None
+                continue
+            counts[name] = self.hits[start]
+            last = self.body[end - 1]
+            n = self.hits[end - 1]
+            if last["op"] == "jmp":
+                out[last["labels"][0]] = n
+            elif last["op"] == "br":
+                t, f = last["labels"]
+                out[t] = self.taken[end - 1]
+                out[f] = out.get(f, 0) + n - self.taken[end - 1]
+            elif last["op"] != "ret" and nxt is not None:
+                out[nxt] = n
+
+        for i, (name, start, end) in enumerate(self.blocks):
+            if counts[name] is None:
+                n = self.calls if i == 0 else 0
+                n += sum(out.get(name, 0) for out in edges.values())
+                counts[name] = n
+                if i + 1 < len(self.blocks):
+                    edges[name][self.blocks[i + 1][0]] = n
+        return counts, edges
+
+    def slot(self, name):
+        n = self.slots.get(name)
+        if n is None:
+            n = self.slots[name] = len(self.slots)
+        return n
+
+    def lower(self, ins, pc, labels):
+        op = ins["op"]
+        if op not in SUPPORTED_OPS:
+            raise RuntimeError(op)
+        nxt = pc + 1
+        args = [self.slot(a) for a in ins.get("args", [])]
+
+        if op == "const":
+            d = self.slot(ins["dest"])
+            v = ins["value"]
+            def run(regs):
+                regs[d] = v
+                return nxt
+        elif op in BINARY_OPS:
+            d = self.slot(ins["dest"])
+            f = BINARY_OPS[op]
+            a, b = args
+            def run(regs):
+                regs[d] = f(regs[a], regs[b])
+                return nxt
+        elif op == "not":
+            d = self.slot(ins["dest"])
+            a, = args
+            def run(regs):
+                regs[d] = not regs[a]
+                return nxt
+        elif op == "id":
+            d = self.slot(ins["dest"])
+            a, = args
+            def run(regs):
+                regs[d] = regs[a]
+                return nxt
+        elif op == "print":
+            def run(regs):
+                print(*[regs[a] for a in args])
+                return nxt
+        elif op == "jmp":
+            tgt = labels[ins["labels"][0]]
+            return STEP, lambda regs: tgt, None
+        elif op == "br":
+            c, = args
+            t, f = labels[ins["labels"][0]], labels[ins["labels"][1]]
+            return BR, (c, t, f) + self.table.guards(ins["args"][0]), None
+        elif op == "call":
+            if "dest" in ins:
+                dest = self.slot(ins["dest"])
+                result = (ins["dest"], ins["type"])
+            else:
+                dest = result = None
+            return CALL, (ins["funcs"][0], args, ins.get("args", []), dest, result), None
+        else:  # ret
+            ret = (args[0], ins["args"][0]) if args else None
+            return RET, ret, self.table.add(ins)
+        return STEP, run, self.table.add(ins)
+
+def compile_program(prog):
+    """Lower every function of a program, keyed by name."""
+    table = StaticTable()
+    return {fn["name"]: CompiledFunction(fn, table) for fn in prog["functions"]}
+
+def run_function(cfn, func_table, args_vals, trace=None, hot=None):
+    """Run a compiled function, appending what it executes to `trace`
+    (a fresh `TraceBuffer` if none is given). `hot`, if given, is a
+    `HotLoop` told about back edges and returns. Returns the return
+    value, the trace and the dynamic instruction count. Each function's
+    profile counters are bumped along the way.
+
+    Calls do not recurse in Python: the caller's state is pushed on an
+    explicit frame stack and every frame records into the same trace,
+    with `id` copies for the arguments and the result. The trace's
+    `depth` follows the stack, so inlined frames get their own names.
+    """
+    if trace is None:
+        trace = TraceBuffer(cfn.table)
+
+    def executed():
+        return sum(sum(f.hits) for f in func_table.values())
+    before = executed()
+
+    code = cfn.code
+    hits, took = cfn.hits, cfn.taken
+    cfn.calls += 1
+    regs = [None] * cfn.nslots
+    for p, v in zip(cfn.params, args_vals):
+        regs[p] = v
+
+    # Suspended callers: (function, registers, return pc, dest slot,
+    # (dest name, type) of the result).
+    stack = []
+    pc = 0
+    end = len(code)
+
+    while True:
+        if pc < end:
+            kind, run, sid = code[pc]
+            hits[pc] += 1
+            if kind == STEP:
+                if sid is not None:
+                    trace.record(sid)
+                    pc = run(regs)
+                else:
+                    nxt = run(regs)
+                    if hot is not None and nxt <= pc:
+                        hot.back_edge(cfn, nxt, regs)
+                    pc = nxt
+                continue
+
+            if kind == BR:
+                c, t, f, taken, negate, not_taken = run
+                if regs[c]:
+                    trace.record(taken)
+                    took[pc] += 1
+                    nxt = t
+                else:
+                    trace.record(negate)
+                    trace.record(not_taken)
+                    nxt = f
+                if hot is not None and nxt <= pc:
+                    hot.back_edge(cfn, nxt, regs)
+                pc = nxt
+                continue
+
+            if kind == CALL:
+                name, arg_slots, arg_names, dest, result = run
+                callee = func_table[name]
+                arg_vals = [regs[a] for a in arg_slots]
+                if hot is not None:
+                    hot.call(regs)
+                level = trace.depth - trace.base
+                for (p, typ), a in zip(callee.signature, arg_names):
+                    trace.record_copy(p, level + 1, typ, a, level)
+                stack.append((cfn, regs, pc + 1, dest, result))
+                trace.depth += 1
+
+                cfn = callee
+                code = cfn.code
+                hits, took = cfn.hits, cfn.taken
+                cfn.calls += 1
+                regs = [None] * cfn.nslots
+                for p, v in zip(cfn.params, arg_vals):
+                    regs[p] = v
+                pc = 0
+                end = len(code)
+                continue
+
+            # Only the outermost return stays in the trace.
+            if not stack:
+                trace.record(sid)
+            if run is None:
+                ret_val = ret_name = None
+            else:
+                ret_val, ret_name = regs[run[0]], run[1]
+        else:
+            ret_val = ret_name = None  # Fell off the end of the function.
+
+        if hot is not None:
+            hot.leave(regs)
+        if not stack:
+            return ret_val, trace, executed() - before
+
+        cfn, regs, pc, dest, result = stack.pop()
+        code = cfn.code
+        hits, took = cfn.hits, cfn.taken
+        end = len(code)
+        trace.depth -= 1
+        if dest is not None:
+            regs[dest] = ret_val
+            if ret_name is not None:
+                level = trace.depth - trace.base
+                trace.record_copy(result[0], level, result[1], ret_name, level + 1)
+
+def final_ret(trace):
+    """If the trace ends in a bare `ret`, make it return the last value
+    the trace defined. Returns the instruction to use in its place, or
+    None to leave the trace alone.
+    """
+    entries = trace.table.entries
+    if not len(trace):
+        return None
+    last = entries[trace.sids[-1]]
+    if last["op"] != "ret" or last.get("args"):
+        return None
+    for i in range(len(trace) - 2, -1, -1):
+        ins = entries[trace.sids[i]]
+        if "dest" in ins:
+            return dict(last, args=[ins["dest"]])
+    return None
+
+def write_trace(f, init_list, trace):
+    """Write a trace program as JSON, streaming the instructions. The
+    layout matches `json.dump(..., indent=2)` of the whole program.
+    Each static instruction is encoded once and the text reused.
+    """
+    def encode(ins):
+        return "        " + json.dumps(ins, indent=2).replace("\n", "\n        ")
+
+    entries = trace.table.entries
+    ret = final_ret(trace)
+    last = len(trace) - 1
+    encoded = {}
+
+    def texts():
+        for ins in init_list:
+            yield encode(ins)
+        for i, sid in enumerate(trace.sids):
+            if i == last and ret is not None:
+                yield encode(ret)
+            else:
+                text = encoded.get(sid)
+                if text is None:
+                    text = encoded[sid] = encode(entries[sid])
+                yield text
+
+    f.write('{\n  "functions": [\n    {\n      "name": "main",\n'
+            '      "args": [],\n      "instrs": [')
+    first = True
+    for text in texts():
+        f.write("\n" if first else ",\n")
+        first = False
+        f.write(text)
+    f.write("\n      ]\n" if not first else "]\n")
+    f.write("    }\n  ]\n}")
+
+def write_jsonl(f, init_list, trace, meta=None):
+    """Write a recorded trace as JSON Lines. `meta`, if given, goes on
+    the first line as {"trace": meta}.
+    """
+    if meta is not None:
+        f.write(json.dumps({"trace": meta}) + "\n")
+    out = JsonLinesSink(f, trace.table)
+    for ins in init_list:
+        out.write(ins)
+    for sid in trace.sids:
+        out.emit(sid)
+
+def write_loop_traces(f, traces, jsonl=False, stats=None):
+    """Write the traces a `HotLoop` collected, each tagged with the
+    function and loop header it belongs to, and with its `HotLoop.stats`
+    if given. As JSON this is {"traces": [{"function", "header",
+    "instrs", ...}, ...]}; as JSON Lines each trace is its metadata line
+    followed by its instructions.
+    """
+    stats = stats or {}
+    def meta(fn, header):
+        return dict({"function": fn, "header": header}, **stats.get((fn, header), {}))
+    if jsonl:
+        for fn, header, trace in traces:
+            write_jsonl(f, [], trace, meta(fn, header))
+        return
+    json.dump({"traces": [
+        dict(meta(fn, header), instrs=list(trace.instrs()))
+        for fn, header, trace in traces
+    ]}, f, indent=2)
+
+def write_profile(f, func_table, dyn):
+    """Dump block and edge counts for every function as JSON:
+    {"total_dyn_inst": n, "functions": {name: {"calls", "blocks",
+    "edges"}}}, where "edges" maps a block to {successor: count}.
+    """
+    functions = {}
+    for name, cfn in func_table.items():
+        counts, edges = cfn.profile()
+        functions[name] = {"calls": cfn.calls, "blocks": counts, "edges": edges}
+    json.dump({"total_dyn_inst": dyn, "functions": functions}, f, indent=2)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("prog")
+    ap.add_argument("--arg", action="append", default=[])
+    ap.add_argument("-o", "--out", default="Trace.json")
+    ap.add_argument("--jsonl", action="store_true",
+                    help="write the trace as JSON Lines, streaming it as it runs")
+    ap.add_argument("--max-len", type=int, default=None,
+                    help="stop recording after this many instructions")
+    ap.add_argument("--hot", type=int, default=None, metavar="N",
+                    help="record one iteration of loops whose back edge is taken N times")
+    ap.add_argument("--traces", type=int, default=1, metavar="K",
+                    help="with --hot, stop after tracing K loops")
+    ap.add_argument("--profile", metavar="PATH",
+                    help="write block and edge execution counts to PATH")
+    args = ap.parse_args()
+    with open(args.prog) as f:
+        prog = json.load(f)
+    func_table = compile_program(prog)
+
+    arg_dict = {}
+    for a in args.arg:
+        n,v = a.split("=")
+        arg_dict[n]=int(v)
+
+    main_fn = func_table["main"]
+    params = main_fn.fn.get("args",[])
+    main_args = []
+    for p in params:
+        main_args.append(arg_dict.get(p["name"],0))
+
+    init_list = []
+    for p,v in zip(params, main_args):
+        init_list.append({
+            "dest": p["name"],
+            "op":"const",
+            "type": p["type"],
+            "value": v
+        })
+
+    with open(args.out,"w") as f:
+        if args.hot is not None:
+            # A hot trace starts mid-run, so it has no parameter consts.
+            trace = TraceBuffer(main_fn.table, args.max_len, recording=False)
+            hot = HotLoop(args.hot, trace, args.traces)
+            ret, trace, dyn = run_function(main_fn, func_table, main_args, trace, hot)
+            write_loop_traces(f, hot.traces, args.jsonl, hot.stats(func_table))
+            for fn, header, _ in hot.traces:
+                print(f"traced loop .{header} in @{fn}")
+        elif args.jsonl:
+            sink = JsonLinesSink(f, main_fn.table, args.max_len)
+            for ins in init_list:
+                sink.write(ins)
+            ret, trace, dyn = run_function(main_fn, func_table, main_args, sink)
+        else:
+            trace = TraceBuffer(main_fn.table, args.max_len)
+            ret, trace, dyn = run_function(main_fn, func_table, main_args, trace)
+            write_trace(f, init_list, trace)
+    if args.profile:
+        with open(args.profile, "w") as f:
+            write_profile(f, func_table, dyn)
+    print(f"total_dyn_inst: {dyn}")
+    if trace.truncated:
+        print(f"trace truncated at {len(trace)} instructions")
+    print("Trace generated.")
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,275 @@
+"""Run a directory of Bril benchmarks through pass pipelines in parallel,
+recording the dynamic instruction count of every (benchmark, run) pair
+in the format of result_lvn.csv.
+
+    python bench.py BENCH_DIR --run lvn="python 'test_lvn(4).py'" --plot out.png
+
+Each --run is NAME=COMMAND, where COMMAND is one or more commands joined
+by `|` that each read a JSON program on stdin and write one on stdout.
+A "baseline" run without passes is always included. Programs are
+interpreted with the interpreter from task12/tracer.py, or with `brili
+-p` (see --brili) if they use an op it does not support, such as
+floats, memory or chars; a run whose output differs from the
+baseline's is recorded as "incorrect". Every result that is not a
+count is listed on stderr with its reason, since the chart leaves it
+out.
+"""
+
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+TRACER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "task12")
+
+FIELDS = ["benchmark", "run", "result", "wall_time", "peak_kb", "reason"]
+
+
+class Failed(Exception):
+    """A benchmark run that produced no count; the message is the
+    status recorded in place of the result, and `reason`, if given,
+    says why.
+    """
+
+    def __init__(self, status, reason=""):
+        super().__init__(status)
+        self.reason = reason
+
+
+def find_benchmarks(directory):
+    """Benchmark files in a directory, by name. A program given both as
+    .bril and .json is read from the .json, which needs no bril2json.
+    """
+    found = {}
+    for entry in sorted(os.listdir(directory)):
+        stem, ext = os.path.splitext(entry)
+        if ext == ".json" or (ext == ".bril" and stem not in found):
+            found[stem] = os.path.join(directory, entry)
+    return sorted(found.items())
+
+
+def bench_args(path):
+    """The arguments from a `# ARGS:` line in the benchmark's .bril
+    source, if there is one.
+    """
+    src = os.path.splitext(path)[0] + ".bril"
+    if not os.path.exists(src):
+        return []
+    with open(src) as f:
+        for line in f:
+            if line.startswith("# ARGS:"):
+                return line[len("# ARGS:"):].split()
+    return []
+
+
+def load(path):
+    if path.endswith(".json"):
+        with open(path, "rb") as f:
+            return f.read()
+    with open(path, "rb") as f:
+        try:
+            proc = subprocess.run(["bril2json"], stdin=f, capture_output=True, check=True)
+        except FileNotFoundError:
+            raise Failed("missing")
+        except subprocess.CalledProcessError:
+            raise Failed("error")
+    return proc.stdout
+
+
+def run_stage(cmd, data, timeout):
+    """Run one pass as a child process, feeding it `data`. Returns its
+    output, wall time and peak resident memory in KB.
+
+    The child is reaped with wait4, so its resource usage (and that of
+    anything it waited for) is measured on its own rather than mixed
+    into every child this worker has run. Linux counts the resident set
+    a child had when it exec'd, so the forking worker's own size is a
+    floor on the peak reported.
+    """
+    with tempfile.TemporaryFile() as fin, tempfile.TemporaryFile() as fout:
+        fin.write(data)
+        fin.seek(0)
+        start = time.perf_counter()
+        proc = subprocess.Popen(shlex.split(cmd), stdin=fin, stdout=fout,
+                                stderr=subprocess.DEVNULL)
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+        _, status, usage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+        timed_out = not timer.is_alive()
+        timer.cancel()
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        if timed_out:
+            raise Failed("timeout")
+        if proc.returncode != 0:
+            raise Failed("error")
+        fout.seek(0)
+        return fout.read(), elapsed, usage.ru_maxrss
+
+
+def alarm(signum, frame):
+    raise Failed("timeout")
+
+
+def run_brili(prog, args, timeout, brili):
+    """Run a program with the reference interpreter, `brili -p`.
+    Returns what it printed and its dynamic instruction count.
+    """
+    try:
+        proc = subprocess.run(shlex.split(brili) + ["-p"] + list(args),
+                              input=json.dumps(prog).encode(),
+                              capture_output=True, timeout=timeout)
+    except FileNotFoundError:
+        raise Failed("unsupported", "needs {}, which is not installed".format(brili))
+    except subprocess.TimeoutExpired:
+        raise Failed("timeout")
+    if proc.returncode != 0:
+        lines = proc.stderr.decode(errors="replace").strip().splitlines()
+        raise Failed("error", lines[-1] if lines else "")
+    for line in proc.stderr.decode().splitlines():
+        if line.startswith("total_dyn_inst:"):
+            return proc.stdout.decode(), int(line.split(":")[1])
+    raise Failed("error", "no total_dyn_inst from {}".format(brili))
+
+
+def interpret(prog, args, timeout, brili="brili"):
+    """Run a program with the tracer's interpreter, without recording.
+    Returns what it printed and its dynamic instruction count. A program
+    still running after `timeout` seconds is stopped by SIGALRM.
+
+    The tracer only knows the core integer and boolean ops; a program
+    that uses any other is run with `run_brili` instead.
+    """
+    if TRACER_DIR not in sys.path:
+        sys.path.insert(0, TRACER_DIR)
+    import tracer
+
+    # Parameters without an argument default to 0, as in tracer.py.
+    main = next(f for f in prog["functions"] if f["name"] == "main")
+    params = main.get("args", [])
+    args = list(args[:len(params)])
+    args += ["false" if p["type"] == "bool" else "0" for p in params[len(args):]]
+
+    ops = {ins["op"] for func in prog["functions"] for ins in func["instrs"]
+           if "op" in ins}
+    if ops - tracer.SUPPORTED_OPS:
+        return run_brili(prog, args, timeout, brili)
+
+    func_table = tracer.compile_program(prog)
+    main = func_table["main"]
+    vals = [a == "true" if p["type"] == "bool" else int(a) for p, a in zip(params, args)]
+
+    out = io.StringIO()
+    old = signal.signal(signal.SIGALRM, alarm)
+    signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        with contextlib.redirect_stdout(out):
+            trace = tracer.TraceBuffer(main.table, recording=False)
+            _, _, dyn = tracer.run_function(main, func_table, vals, trace)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, old)
+    return out.getvalue(), dyn
+
+
+def run_one(name, path, run, stages, timeout, brili="brili"):
+    """Apply a run's passes to one benchmark and interpret the result."""
+    row = {"benchmark": name, "run": run, "result": None,
+           "wall_time": "", "peak_kb": "", "output": None, "reason": ""}
+    try:
+        data = load(path)
+        wall = 0.0
+        peak = 0
+        for cmd in stages:
+            data, elapsed, rss = run_stage(cmd, data, timeout)
+            wall += elapsed
+            peak = max(peak, rss)
+        if stages:
+            row["wall_time"] = "{:.4f}".format(wall)
+            row["peak_kb"] = peak
+        row["output"], row["result"] = interpret(json.loads(data), bench_args(path),
+                                                 timeout, brili)
+    except Failed as e:
+        row["result"] = str(e)
+        row["reason"] = e.reason
+    except Exception as e:
+        row["result"] = "error"
+        row["reason"] = "{}: {}".format(type(e).__name__, e)
+    return row
+
+
+def parse_run(spec):
+    name, _, cmd = spec.partition("=")
+    if not name or not cmd:
+        raise SystemExit("--run takes NAME=COMMAND, not {!r}".format(spec))
+    return name, [stage.strip() for stage in cmd.split("|")]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("bench_dir")
+    ap.add_argument("--run", action="append", default=[], metavar="NAME=COMMAND")
+    ap.add_argument("-o", "--out", default="results.csv")
+    ap.add_argument("--plot", metavar="PNG", help="also draw the grouped bar chart")
+    ap.add_argument("-j", "--jobs", type=int, default=None)
+    ap.add_argument("--timeout", type=float, default=60.0,
+                    help="seconds each pass, and each interpreted run, may take")
+    ap.add_argument("--brili", default="brili",
+                    help="interpreter for programs the tracer cannot run")
+    args = ap.parse_args()
+
+    runs = [("baseline", [])] + [parse_run(spec) for spec in args.run]
+    benchmarks = find_benchmarks(args.bench_dir)
+
+    with ProcessPoolExecutor(args.jobs) as pool:
+        futures = [
+            pool.submit(run_one, name, path, run, stages, args.timeout, args.brili)
+            for name, path in benchmarks
+            for run, stages in runs
+        ]
+        rows = [f.result() for f in futures]
+
+    expected = {r["benchmark"]: r["output"] for r in rows if r["run"] == "baseline"}
+    for r in rows:
+        base = expected.get(r["benchmark"])
+        if r["output"] is not None and base is not None and r["output"] != base:
+            r["result"] = "incorrect"
+        r["result"] = str(r["result"])
+
+    with open(args.out, "w", newline="") as f:
+        writer = csv.DictWriter(f, FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+    print("{} results written to {}".format(len(rows), args.out))
+
+    # Only counts are compared and charted; say what was left out.
+    left_out = [r for r in rows if not r["result"].isdigit()]
+    for r in left_out:
+        reason = ": " + r["reason"] if r["reason"] else ""
+        print("{} {}: {}{}".format(r["benchmark"], r["run"], r["result"], reason),
+              file=sys.stderr)
+    if left_out:
+        print("{} of {} results have no count and are left out of the chart".format(
+            len(left_out), len(rows)), file=sys.stderr)
+
+    if args.plot:
+        try:
+            import graph
+            graph.plot(rows, args.plot)
+        except ImportError:
+            print("matplotlib is not installed; no chart drawn", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""Constant folding and algebraic identities of Bril ops, shared by the
+optimizations that simplify instructions.
+"""
+
+
+def wrap(n):
+    """Wrap an integer to a signed 64-bit value, like Bril ints."""
+    n &= (1 << 64) - 1
+    return n - (1 << 64) if n >= 1 << 63 else n
+
+
+def trunc_div(a, b):
+    """Integer division that truncates toward zero."""
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+
+# Ops whose arguments can be put in any order.
+COMMUTATIVE = {"add", "mul", "and", "or", "eq", "fadd", "fmul", "feq"}
+
+# Ops to evaluate when all arguments are known constants. Division by
+# zero is left to the caller, which should not fold it.
+FOLD = {
+    "add": lambda a, b: wrap(a + b),
+    "sub": lambda a, b: wrap(a - b),
+    "mul": lambda a, b: wrap(a * b),
+    "div": lambda a, b: wrap(trunc_div(a, b)),
+    "eq": lambda a, b: a == b,
+    "lt": lambda a, b: a < b,
+    "gt": lambda a, b: a > b,
+    "le": lambda a, b: a <= b,
+    "ge": lambda a, b: a >= b,
+    "and": lambda a, b: a and b,
+    "or": lambda a, b: a or b,
+    "not": lambda a: not a,
+}
+
+# Constant right operands that make an op a copy of its left operand
+# (x + 0, x * 1, ...). Commutative ops also accept them on the left.
+IDENTITY = {"add": 0, "sub": 0, "mul": 1, "div": 1, "and": True, "or": False}
+
+# Results of integer ops applied to the same value twice (x - x, ...).
+SAME_ARGS = {"sub": 0, "eq": True, "le": True, "ge": True, "lt": False, "gt": False}
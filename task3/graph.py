@@ -1,35 +1,68 @@
-import matplotlib.pyplot as plt
-import numpy as np
+import csv
+import sys
 
-# 剔除result中超过10000的数据
-filtered_df = df[df['result'] <= 10000]
 
-# 按照benchmark和run列进行分组，并获取result列的值
-grouped = filtered_df.groupby(['benchmark', 'run'])['result'].first().unstack()
+def load(path):
+    # 读取bench.py写出的结果（benchmark, run, result, ...）
+    with open(path, newline="") as f:
+        return list(csv.DictReader(f))
 
-# 设置图形参数
-num_benchmarks = len(grouped.index)
-num_runs = len(grouped.columns)
-width = 0.8 / num_runs
-index = np.arange(num_benchmarks)
 
-# 创建画布
-fig, ax = plt.subplots(figsize=(12, 6))
+def plot(rows, out=None, limit=10000):
+    import matplotlib
+    if out is not None:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
 
-# 绘制柱状图
-for i, run in enumerate(grouped.columns):
-    ax.bar(index + i * width, grouped[run], width, label=run)
+    # 剔除result中超过limit的数据，以及incorrect等非数字结果
+    filtered = [r for r in rows if r["result"].isdigit() and int(r["result"]) <= limit]
 
-# 设置标签和标题
-ax.set_xlabel('benchmark')
-ax.set_ylabel('result')
-ax.set_title('不同benchmark和run组合的result值（剔除超过10000的数据）')
-ax.set_xticks(index + width * (num_runs - 1) / 2)
-ax.set_xticklabels(grouped.index, rotation=45, fontsize=6)
+    # 按照benchmark和run列进行分组，并获取result列的值
+    benchmarks = []
+    runs = []
+    grouped = {}
+    for r in filtered:
+        if r["benchmark"] not in grouped:
+            benchmarks.append(r["benchmark"])
+            grouped[r["benchmark"]] = {}
+        if r["run"] not in runs:
+            runs.append(r["run"])
+        grouped[r["benchmark"]].setdefault(r["run"], int(r["result"]))
+    if not benchmarks:
+        return
 
-# 显示图例
-ax.legend()
+    # 设置图形参数
+    num_runs = len(runs)
+    width = 0.8 / num_runs
+    index = list(range(len(benchmarks)))
 
-# 显示图形
-plt.tight_layout()
-plt.show()
\ No newline at end of file
+    # 创建画布
+    fig, ax = plt.subplots(figsize=(12, 6))
+
+    # 绘制柱状图，缺少的结果画成0
+    for i, run in enumerate(runs):
+        heights = [grouped[b].get(run, 0) for b in benchmarks]
+        ax.bar([x + i * width for x in index], heights, width, label=run)
+
+    # 设置标签和标题
+    ax.set_xlabel('benchmark')
+    ax.set_ylabel('result')
+    ax.set_title('不同benchmark和run组合的result值（剔除超过{}的数据）'.format(limit))
+    ax.set_xticks([x + width * (num_runs - 1) / 2 for x in index])
+    ax.set_xticklabels(benchmarks, rotation=45, fontsize=6)
+
+    # 显示图例
+    ax.legend()
+
+    # 显示或保存图形
+    plt.tight_layout()
+    if out is None:
+        plt.show()
+    else:
+        fig.savefig(out)
+    plt.close(fig)
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else "result_lvn.csv"
+    plot(load(path), sys.argv[2] if len(sys.argv) > 2 else None)
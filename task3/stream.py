@@ -0,0 +1,182 @@
+"""Read and write Bril programs one function at a time.
+
+`read_functions` parses a program from a file incrementally and yields
+each function as soon as it has been read, and `write_functions` writes
+each function as soon as it is produced. A per-function pass run
+between the two holds one function in memory at a time rather than the
+whole program.
+
+With `jobs`, `map_functions` hands functions to a pool of worker
+processes instead. Workers get the parsed function (pickled, which is
+smaller and faster than JSON text) and send back its formatted text, so
+formatting is parallel too. Results are written in the order the
+functions were read, whichever worker finishes first.
+"""
+
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    """A window onto a text file, refilled as parsing needs more of it."""
+
+    def __init__(self, f, chunk):
+        self.f = f
+        self.chunk = chunk
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def fill(self):
+        # Drop what has been parsed, then read at least as much as is
+        # buffered, so a value that spans many chunks is re-parsed only
+        # a logarithmic number of times.
+        self.buf = self.buf[self.pos:]
+        self.pos = 0
+        more = self.f.read(max(self.chunk, len(self.buf)))
+        if more:
+            self.buf += more
+        else:
+            self.eof = True
+
+    def peek(self):
+        """The next non-space character, or "" at the end of the file."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\n\r":
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return self.buf[self.pos:self.pos + 1]
+            self.fill()
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("expected {!r} at {!r}".format(chars, self.buf[self.pos:self.pos + 20]))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """Parse one complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self.fill()
+                continue
+            # A number that ends the buffer may go on in the next chunk.
+            if end == len(self.buf) and not self.eof:
+                self.fill()
+                continue
+            self.pos = end
+            return obj
+
+
+def read_functions(f, header=None, chunk=1 << 16):
+    """Yield the functions of a Bril program read from text file `f`,
+    one by one as they are parsed. Other top-level keys are stored in
+    the dict `header`, if one is given; keys after the "functions"
+    array only show up there once every function has been yielded.
+    """
+    r = _Reader(f, chunk)
+    r.expect("{")
+    if r.peek() == "}":
+        return
+    while True:
+        key = r.value()
+        r.expect(":")
+        if key == "functions":
+            r.expect("[")
+            if r.peek() == "]":
+                r.pos += 1
+            else:
+                while True:
+                    yield r.value()
+                    if r.expect(",]") == "]":
+                        break
+        else:
+            value = r.value()
+            if header is not None:
+                header[key] = value
+        if r.expect(",}") == "}":
+            return
+
+
+def write_functions(f, functions, header=None):
+    """Write a program to `f`, taking its functions one at a time from
+    the iterable `functions`. `header` holds any other top-level keys;
+    it is only read after the last function, so it can be the dict
+    `read_functions` fills in.
+
+    The output is that of `json.dump(program, f, indent=2,
+    sort_keys=True)`, except that other top-level keys always come
+    after "functions".
+    """
+    write_texts(f, map(format_function, functions), header)
+
+
+def format_function(func):
+    """A function's JSON text as it appears inside a program written by
+    `write_functions`.
+    """
+    return json.dumps(func, indent=2, sort_keys=True).replace("\n", "\n    ")
+
+
+def write_texts(f, texts, header=None):
+    """`write_functions`, for functions already run through
+    `format_function`.
+    """
+    f.write('{\n  "functions": [')
+    first = True
+    for text in texts:
+        f.write("\n    " if first else ",\n    ")
+        first = False
+        f.write(text)
+    f.write("]" if first else "\n  ]")
+    for key in sorted(header or ()):
+        text = json.dumps(header[key], indent=2, sort_keys=True).replace("\n", "\n  ")
+        f.write(",\n  {}: {}".format(json.dumps(key), text))
+    f.write("\n}")
+
+
+def parallel_map(fn, items, jobs, window=None):
+    """Yield `fn(item)` for each item, in order, computed in a pool of
+    `jobs` processes. At most `window` items (by default four per
+    process) are in flight, so items are read only as fast as they are
+    used. `fn` and the items have to be picklable.
+    """
+    window = window or 4 * jobs
+    with ProcessPoolExecutor(jobs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append(pool.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def _transform_text(transform, func):
+    return format_function(transform(func))
+
+
+def map_functions(transform, fin, fout, jobs=None):
+    """Stream a program from `fin` to `fout`, passing each function
+    through `transform`, which returns the function to write. With
+    `jobs`, functions are transformed in that many processes; then
+    `transform` has to be a module-level function (or a `partial` of
+    one) so that it can be pickled.
+    """
+    header = {}
+    functions = read_functions(fin, header)
+    if jobs:
+        texts = parallel_map(partial(_transform_text, transform), functions, jobs)
+    else:
+        texts = (format_function(transform(func)) for func in functions)
+    write_texts(fout, texts, header)
@@ -1,9 +1,15 @@
 import json
+import os
 import sys
+import time
+from functools import partial
 from collections import namedtuple
 
 from form_blocks import form_blocks
 from util import flatten
+from fold import COMMUTATIVE, FOLD, IDENTITY, SAME_ARGS
+from stream import map_functions
+from cache import cache_arg, cached
 
 Value = namedtuple("Value", ["op", "args"])
 
@@ -41,46 +47,98 @@ def if_external(instrs):
             dests.add(instr['dest'])
     return res
 
+def first(names):
+    # The canonical name of a value number.
+    return next(iter(names))
+
+def to_const(instr, value):
+    instr['op'] = 'const'
+    instr['value'] = value
+    del instr['args']
+
+def simplify(instr, nums_arg, num2const):
+    """Fold constants and apply algebraic identities to an instruction,
+    rewriting it in place into a `const` or an `id` where possible.
+    Returns the (possibly shortened) tuple of argument numbers.
+    """
+    op = instr['op']
+    consts = [num2const.get(num) for num in nums_arg]
+
+    if op in FOLD and nums_arg and None not in consts:
+        if op == 'div' and consts[1] == 0:
+            return nums_arg  # Leave the trap to run time.
+        to_const(instr, FOLD[op](*consts))
+        return ()
+
+    if len(nums_arg) != 2:
+        return nums_arg
+    if op in SAME_ARGS and nums_arg[0] == nums_arg[1]:
+        to_const(instr, SAME_ARGS[op])
+        return ()
+
+    if op in IDENTITY:
+        unit = IDENTITY[op]
+        for i in ((1, 0) if op in COMMUTATIVE else (1,)):
+            if consts[i] is not None and type(consts[i]) is type(unit) and consts[i] == unit:
+                instr['op'] = 'id'
+                instr['args'] = [instr['args'][1 - i]]
+                return (nums_arg[1 - i],)
+    return nums_arg
+
 def lvn(block):
     var2num=Numbering()
+    # Each number maps to the names holding it, as an insertion-ordered
+    # dict, and holder maps each name back to that number, so dropping a
+    # stale name is O(1).
     num2var={}
+    holder={}
     value2num={}
+    num2const={}
     res=if_overwritten(block)
 
     for var in if_external(block):
         num=var2num.add(var)
-        num2var[num]=[var]
+        num2var[num]={var: None}
+        holder[var]=num
 
-    index=0
-    for instr in block:
+    for index, instr in enumerate(block):
         args=instr.get('args',[])
         nums_arg=tuple(var2num[var] for var in args)
         val=None
 
         if 'args' in instr:
-            instr['args']=[num2var[num1][0] for num1 in nums_arg]
+            instr['args']=[first(num2var[num1]) for num1 in nums_arg]
         if 'dest' in instr:
-            for rhs in num2var.values():
-                if instr["dest"] in rhs:
-                    rhs.remove(instr["dest"])
+            old=holder.pop(instr["dest"],None)
+            if old is not None:
+                del num2var[old][instr["dest"]]
+
+        if "dest" in instr and instr["op"] != "call":
+            if "args" in instr:
+                nums_arg = simplify(instr, nums_arg, num2const)
 
-        if "dest" in instr and "args" in instr and instr["op"] != "call":
             if instr['op'] == 'id' and len(nums_arg) == 1:
                 var2num[instr['dest']] = nums_arg[0]
-                num2var[nums_arg[0]].append(instr['dest'])
+                num2var[nums_arg[0]][instr['dest']] = None
+                holder[instr['dest']] = nums_arg[0]
                 continue
-            
-            if instr['op'] in ['add', 'mul']:
-                val = Value(instr['op'], tuple(sorted(nums_arg)))
-            else:
-                val = Value(instr['op'], tuple(nums_arg))
-            
-            num = value2num.get(val)
+
+            if instr['op'] == 'const':
+                val = Value('const', (instr['type'], instr['value']))
+            elif "args" in instr:
+                if instr['op'] in COMMUTATIVE:
+                    val = Value(instr['op'], tuple(sorted(nums_arg)))
+                else:
+                    val = Value(instr['op'], tuple(nums_arg))
+
+            num = value2num.get(val) if val is not None else None
             if num is not None:
                 var2num[instr['dest']] = num
-                instr['op'] = 'id'
-                instr['args'] = [num2var[num][0]]
-                num2var[num].append(instr['dest'])
+                if instr['op'] != 'const':
+                    instr['op'] = 'id'
+                    instr['args'] = [first(num2var[num])]
+                num2var[num][instr['dest']] = None
+                holder[instr['dest']] = num
                 continue
 
         if 'dest' in instr:
@@ -91,24 +149,49 @@ def lvn(block):
                 var = "temp{}".format(update_num)
             else:
                 var = instr['dest']
-            num2var[update_num]=[var]
+            num2var[update_num]={var: None}
+            holder[var]=update_num
             instr['dest']=var
 
             if val is not None:
                 value2num[val]=update_num
+            if instr['op'] == 'const':
+                num2const[update_num]=instr['value']
 
-        index+=1
-def start(bril):
+def start(bril, bench=False):
     for func in bril["functions"]:
         blocks = list(form_blocks(func["instrs"]))
-        for block in blocks:
+        for i, block in enumerate(blocks):
+            before = time.perf_counter()
             lvn(block)
+            if bench:
+                elapsed = time.perf_counter() - before
+                print("{} block {}: {} instrs, {:.3f} ms".format(
+                    func["name"], i, len(block), elapsed * 1000), file=sys.stderr)
         func["instrs"] = flatten(blocks)
 
+def start_one(func, bench=False):
+    start({"functions": [func]}, bench)
+    return func
+
 if __name__ == "__main__":
-    bril = json.load(sys.stdin)
-    start(bril)
-    json.dump(bril, sys.stdout, indent=2, sort_keys=True)
+    args = sys.argv[1:]
+    bench = "--bench" in args
+    jobs = int(args[args.index("--jobs") + 1]) if "--jobs" in args else None
+    cache = cache_arg(args)
+    if jobs or cache or "--stream" in args:
+        # Functions are optimized one at a time as they are read, or
+        # spread over `jobs` worker processes; unchanged ones can come
+        # from the cache.
+        transform = cached(partial(start_one, bench=bench), "lvn", cache,
+                           os.path.dirname(os.path.abspath(__file__)))
+        map_functions(transform, sys.stdin, sys.stdout, jobs)
+        if cache:
+            cache.evict()
+    else:
+        bril = json.load(sys.stdin)
+        start(bril, bench)
+        json.dump(bril, sys.stdout, indent=2, sort_keys=True)
 
 
 
@@ -0,0 +1,46 @@
+"""Sets of names stored as integer bitmasks, for data-flow facts."""
+
+
+class Interner(dict):
+    """Map names to dense integer ids, handing out ids in the order names
+    are first seen. The set of names {a, b} is then the bitmask
+    `1 << id(a) | 1 << id(b)`, so union, intersection and equality are
+    single integer operations.
+    """
+
+    def __init__(self):
+        super(Interner, self).__init__()
+        self.names = []
+
+    def add(self, name):
+        """Get the id of a name, assigning a fresh one if it is new."""
+        n = self.get(name)
+        if n is None:
+            n = len(self.names)
+            self[name] = n
+            self.names.append(name)
+        return n
+
+    def mask(self, names):
+        """Pack an iterable of names into a bitmask."""
+        out = 0
+        for name in names:
+            out |= 1 << self.add(name)
+        return out
+
+    def unpack(self, mask):
+        """List the names in a bitmask, in id order."""
+        out = []
+        while mask:
+            low = mask & -mask
+            out.append(self.names[low.bit_length() - 1])
+            mask ^= low
+        return out
+
+
+def union(masks):
+    """Merge a list of bitmask facts by union."""
+    out = 0
+    for m in masks:
+        out |= m
+    return out
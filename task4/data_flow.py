@@ -1,47 +1,200 @@
 import sys
 import json
+import heapq
 from collections import namedtuple
 
 from form_blocks import form_blocks
 import cfg
+from bitvec import Interner, union
+from traversal import traverse
 
 def get_pred_succ(blocks):
     cfg.add_terminators(blocks)
     pred, succ=cfg.edges(blocks)
     return pred, succ
 
-def merge_cd(out_block):
-    res=set()
-    for output in out_block:
-        res.update(output)
-    return res
+def block_order(blocks, succ):
+    # Reverse postorder from the entry, then any unreachable blocks.
+    t=traverse(succ, next(iter(blocks)))
+    order=[t.names[i] for i in t.rpo]
+    seen=set(t.rpo)
+    order+=[name for i,name in enumerate(t.names) if i not in seen]
+    return order
 
-def transfer_cd(block,in_block):
-    out=set()
+class DataflowAnalysis:
+    """A worklist solver for data-flow problems over a block map.
+
+    `merge` combines a list of facts into one, `transfer` maps a block
+    and its input fact to its output fact, and `bottom` makes the
+    initial fact for every block. A forward analysis flows facts from
+    predecessors to successors; a backward one flows them the other way,
+    so its "input" fact is the one at the end of the block.
+
+    The worklist holds each block at most once and always hands out the
+    block that comes first in reverse postorder (postorder for backward
+    analyses), so facts usually reach a block before it is processed.
+    `transfer` must not modify its input fact.
+    """
+
+    def __init__(self, merge, transfer, bottom, forward=True):
+        self.merge=merge
+        self.transfer=transfer
+        self.bottom=bottom
+        self.forward=forward
+        self.transfers=0  # Transfer applications, for measurement.
+
+    def run(self, blocks):
+        """Solve the analysis on a block map. Returns the facts at the
+        start and at the end of every block, as two dicts.
+        """
+        if not blocks:
+            return {},{}  # An empty function has no blocks to solve.
+        pred,succ=get_pred_succ(blocks)
+        order=block_order(blocks, succ)
+        if self.forward:
+            sources,targets=pred,succ
+        else:
+            sources,targets=succ,pred
+            order.reverse()
+
+        facts_in={name: self.bottom() for name in blocks}
+        facts_out={name: self.bottom() for name in blocks}
+
+        # A heap of priorities (positions in `order`), plus flags so a
+        # block is never queued twice.
+        queued=[True]*len(order)
+        worklist=list(range(len(order)))
+        priority={name: i for i,name in enumerate(order)}
+        while worklist:
+            i=heapq.heappop(worklist)
+            queued[i]=False
+            block=order[i]
+
+            facts_in[block]=self.merge(
+                [facts_out[b] for b in sources[block]])
+            out=self.apply(block, blocks[block], facts_in[block])
+            self.transfers+=1
+            if out!=facts_out[block]:
+                facts_out[block]=out
+                for b in targets[block]:
+                    j=priority[b]
+                    if not queued[j]:
+                        queued[j]=True
+                        heapq.heappush(worklist, j)
+
+        if self.forward:
+            return facts_in,facts_out
+        return facts_out,facts_in
+
+    def apply(self, name, block, fact):
+        return self.transfer(block, fact)
+
+class BitvectorAnalysis(DataflowAnalysis):
+    """A gen/kill data-flow problem whose facts are sets stored as
+    integer bitmasks (see `bitvec.Interner`).
+
+    `local` maps a block name and block to its (gen, kill) masks. They
+    are computed once per block before solving, so each transfer is a
+    couple of integer operations: out = gen | (in & ~kill). Facts are
+    merged by union.
+    """
+
+    def __init__(self, local, forward=True):
+        super().__init__(union, None, int, forward)
+        self.local=local
+
+    def run(self, blocks):
+        cfg.add_terminators(blocks)
+        self.gen_kill={name: self.local(name,block)
+                       for name,block in blocks.items()}
+        return super().run(blocks)
+
+    def apply(self, name, block, fact):
+        gen,kill=self.gen_kill[name]
+        return gen|(fact&~kill)
+
+def local_cd(block,names):
+    gen=0
     for instr in block:
         if 'dest' in instr:
-            out.add(instr['dest'])
-    for var in in_block:
-        out.add(var)
-    out=sorted(out)
-    return out
-    
+            gen|=1<<names.add(instr['dest'])
+    return gen,0
+
 def currently_defined(blocks):
-    pred,succ=get_pred_succ(blocks)
-    in_block={list(blocks.keys())[0]:set()}
-    out_block={node: set() for node in blocks}
-    worklist = list(blocks.keys())
-    while worklist:
-        block=worklist.pop(0)
-        out_pre_block=[out_block[b] for b in pred[block]]
-        in_block[block]=merge_cd(out_pre_block)
-        out_block_current=transfer_cd(blocks[block],in_block[block])
-        if out_block_current != out_block[block]:
-            out_block[block]=out_block_current
-            worklist.extend(succ[block])
+    names=Interner()
+    analysis=BitvectorAnalysis(lambda name,block: local_cd(block,names))
+    in_block,out_block=analysis.run(blocks)
+    print_bits(blocks,(names,in_block,out_block))
+
+def instr_uses(instr):
+    # `set x y` writes the shadow of x that a later `get x` reads, so
+    # only y is an ordinary use.
+    if instr.get('op')=='set':
+        return instr['args'][1:]
+    if instr.get('op')=='get':
+        return [('shadow',instr['dest'])]
+    return instr.get('args',[])
+
+def instr_defs(instr):
+    if instr.get('op')=='set':
+        return [('shadow',instr['args'][0])]
+    if 'dest' in instr:
+        return [instr['dest']]
+    return []
+
+def local_live(block,names):
+    gen=0
+    kill=0
+    for instr in reversed(block):
+        for var in instr_defs(instr):
+            bit=1<<names.add(var)
+            gen&=~bit
+            kill|=bit
+        for var in instr_uses(instr):
+            gen|=1<<names.add(var)
+    return gen,kill
+
+def live_variables(blocks):
+    """Backward liveness. Returns the interner and the live-in and
+    live-out bitmasks of every block.
+    """
+    names=Interner()
+    analysis=BitvectorAnalysis(lambda name,block: local_live(block,names),
+                               forward=False)
+    live_in,live_out=analysis.run(blocks)
+    return names,live_in,live_out
+
+def reaching_definitions(blocks):
+    """Forward reaching definitions. Definitions are interned as
+    (block name, instruction index) pairs. Returns the interner and the
+    in and out bitmasks of every block.
+    """
+    cfg.add_terminators(blocks)
+    sites=Interner()
+    by_var={}
+    for name,block in blocks.items():
+        for i,instr in enumerate(block):
+            for var in instr_defs(instr):
+                by_var[var]=by_var.get(var,0)|1<<sites.add((name,i))
+
+    def local(name,block):
+        last={}
+        for i,instr in enumerate(block):
+            for var in instr_defs(instr):
+                last[var]=1<<sites[(name,i)]
+        gen=union(last.values())
+        kill=union(by_var[var] for var in last)
+        return gen,kill
+
+    analysis=BitvectorAnalysis(local)
+    reach_in,reach_out=analysis.run(blocks)
+    return sites,reach_in,reach_out
+
+def print_bits(blocks,result):
+    names,facts_in,facts_out=result
     for block in blocks:
-        print(block,"in:",set(in_block[block]))
-        print(block,"out:",set(out_block[block]))   
+        print(block,"in:",set(names.unpack(facts_in[block])))
+        print(block,"out:",set(names.unpack(facts_out[block])))
 
 def merge_cp(out_block):
     out={}
@@ -56,7 +209,7 @@ def merge_cp(out_block):
                     out[name]=value
     return out
 def transfer_cp(block,in_block):
-    out=in_block
+    out=dict(in_block)
     for instr in block:
         if 'dest' in instr : 
             if instr['op'] == "const":
@@ -66,29 +219,26 @@ def transfer_cp(block,in_block):
     return out
 
 def const_propagation(blocks):
-    pred,succ=get_pred_succ(blocks)
-    in_block={list(blocks.keys())[0]:{}}
-    out_block={node: {} for node in blocks}
-    worklist = list(blocks.keys())
-    while worklist:
-        block=worklist.pop(0)
-        out_pre_block=[out_block[b] for b in pred[block]]
-        in_block[block]=merge_cp(out_pre_block)
-        out_block_current=transfer_cp(blocks[block],in_block[block])
-        if out_block_current != out_block[block]:
-            out_block[block]=out_block_current
-            worklist.extend(succ[block])
+    analysis=DataflowAnalysis(merge_cp, transfer_cp, dict)
+    in_block,out_block=analysis.run(blocks)
     for block in blocks:
         print(block,"in:",in_block[block])
         print(block,"out:",out_block[block])
-        
-
 
-    
 
-bril = json.load(sys.stdin)
-for func in bril["functions"]:
-    blocks = cfg.block_map(form_blocks(func["instrs"]))         
-    const_propagation(blocks)
+def analyze(bril, mode):
+    for func in bril["functions"]:
+        blocks = cfg.block_map(form_blocks(func["instrs"]))
+        if mode == "defined":
+            currently_defined(blocks)
+        elif mode == "live":
+            print_bits(blocks, live_variables(blocks))
+        elif mode == "reaching":
+            print_bits(blocks, reaching_definitions(blocks))
+        else:
+            const_propagation(blocks)
 
 
+if __name__ == "__main__":
+    mode="cprop" if len(sys.argv) < 2 else sys.argv[1]
+    analyze(json.load(sys.stdin), mode)
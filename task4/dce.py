@@ -0,0 +1,120 @@
+"""Global dead code elimination by mark and sweep over the use-def
+chains of reaching definitions.
+
+Liveness (`live_variables` in data_flow.py) is not used here. A
+definition that is dead at the end of its block reaches no use, so the
+marking never reaches it either, and unlike a liveness sweep the
+marking also removes definitions that only feed each other around a
+loop. `live_variables` stays available as the "live" mode of
+data_flow.py.
+"""
+
+import json
+import sys
+
+import cfg
+from data_flow import reaching_definitions, instr_uses, instr_defs
+from form_blocks import form_blocks
+from util import flatten, fresh
+
+# Instructions that must stay even if their result is never used.
+SIDE_EFFECTS = ("call",)
+
+
+def use_defs(blocks, sites, reach_in):
+    """For every instruction of a block map, the bitmask of definition
+    sites (as numbered by `reaching_definitions`) that reach its uses,
+    keyed by (block name, index).
+    """
+    by_var = {}
+    for (name, i), site in sites.items():
+        for var in instr_defs(blocks[name][i]):
+            by_var[var] = by_var.get(var, 0) | 1 << site
+
+    feeds = {}
+    for name, block in blocks.items():
+        last = {}  # Variable -> its latest definition in the block.
+        for i, instr in enumerate(block):
+            mask = 0
+            for var in instr_uses(instr):
+                bit = last.get(var)
+                if bit is None:
+                    bit = reach_in[name] & by_var.get(var, 0)
+                mask |= bit
+            feeds[(name, i)] = mask
+            for var in instr_defs(instr):
+                last[var] = 1 << sites[(name, i)]
+    return feeds
+
+
+def dce_func(func):
+    """Remove dead instructions from a function in place. Returns the
+    number of instructions removed.
+
+    Instructions that define nothing, or have side effects, are live.
+    So is every definition that reaches a use in a live instruction,
+    which one worklist pass over the use-def chains marks. Everything
+    else is deleted, including definitions that only feed each other
+    around a loop.
+    """
+    # Analyze a copy with terminators added, but sweep the original
+    # blocks so the function keeps its layout.
+    blocks = list(form_blocks(func["instrs"]))
+    # Label the anonymous blocks of the copy apart from every real label:
+    # block_map's own "b" names can clash with one, and then two blocks
+    # would share an entry.
+    labels = {block[0]["label"] for block in blocks if "label" in block[0]}
+    copies = []
+    for block in blocks:
+        if "label" not in block[0]:
+            name = fresh("b", labels)
+            labels.add(name)
+            block = [{"label": name}] + block
+        copies.append(list(block))
+    by_name = cfg.block_map(copies)
+    sites, reach_in, _ = reaching_definitions(by_name)
+    feeds = use_defs(by_name, sites, reach_in)
+
+    live = 0
+    work = []
+
+    def mark(mask):
+        nonlocal live
+        new = mask & ~live
+        live |= new
+        while new:
+            low = new & -new
+            work.append(low.bit_length() - 1)
+            new ^= low
+
+    for name, block in by_name.items():
+        for i, instr in enumerate(block):
+            if not instr_defs(instr) or instr.get("op") in SIDE_EFFECTS:
+                mark(feeds[(name, i)])
+    while work:
+        mark(feeds[sites.names[work.pop()]])
+
+    before = len(func["instrs"])
+    for name, block in zip(by_name, blocks):
+        # The analysis copy has the block's label taken off.
+        offset = 1 if "label" in block[0] else 0
+        block[offset:] = [
+            instr
+            for i, instr in enumerate(block[offset:])
+            if not instr_defs(instr)
+            or instr.get("op") in SIDE_EFFECTS
+            or live >> sites[(name, i)] & 1
+        ]
+    func["instrs"] = flatten(blocks)
+    return before - len(func["instrs"])
+
+
+def dce(bril):
+    for func in bril["functions"]:
+        dce_func(func)
+
+
+if __name__ == "__main__":
+    bril = json.load(sys.stdin)
+    dce(bril)
+    json.dump(bril, sys.stdout, indent=2, sort_keys=True)
@@ -0,0 +1,63 @@
+"""Depth-first orderings of a CFG, computed without recursion.
+
+This is the one copy: task5 and task6 import it from here.
+"""
+
+from collections import namedtuple
+
+# `names` lists the blocks in the order of the successor map; the other
+# fields are lists of indices into `names`. Blocks that cannot be
+# reached from the root appear in none of the orderings.
+Traversal = namedtuple("Traversal", ["names", "index", "preorder", "postorder", "rpo"])
+
+
+def traverse(succ, root):
+    """Given a successor edge map, produce the preorder, postorder and
+    reverse postorder of the nodes reachable from `root`.
+
+    Nothing is cached here: a caller that needs the orderings more than
+    once keeps the Traversal alongside the CFG it was computed from.
+    """
+    names = list(succ)
+    index = {name: i for i, name in enumerate(names)}
+    edges = [[index[s] for s in succ[name]] for name in names]
+
+    explored = [False] * len(names)
+    preorder = []
+    postorder = []
+
+    # Each stack entry is a node and the position of the next successor
+    # to visit, standing in for a recursive call frame.
+    start = index[root]
+    explored[start] = True
+    preorder.append(start)
+    stack = [(start, 0)]
+    while stack:
+        node, i = stack[-1]
+        out = edges[node]
+        if i < len(out):
+            stack[-1] = (node, i + 1)
+            s = out[i]
+            if not explored[s]:
+                explored[s] = True
+                preorder.append(s)
+                stack.append((s, 0))
+        else:
+            stack.pop()
+            postorder.append(node)
+
+    return Traversal(names, index, preorder, postorder, postorder[::-1])
+
+
+def postorder(succ, root):
+    """Given a successor edge map, produce a list of all the nodes
+    reachable from `root` in postorder.
+    """
+    t = traverse(succ, root)
+    return [t.names[i] for i in t.postorder]
+
+
+def reverse_postorder(succ, root):
+    """Like `postorder`, but in reverse postorder."""
+    t = traverse(succ, root)
+    return [t.names[i] for i in t.rpo]
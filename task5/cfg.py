@@ -1,6 +1,6 @@
 from collections import OrderedDict
-from util import fresh, flatten
-from form_blocks import TERMINATORS
+from util import fresh
+from form_blocks import TERMINATORS, form_blocks
 
 
 def block_map(blocks):
@@ -13,6 +13,7 @@ def block_map(blocks):
     labels removed.
     """
     by_name = OrderedDict()
+    n = 1
 
     for block in blocks:
         # Generate a name for the block.
@@ -22,8 +23,13 @@ def block_map(blocks):
             name = block[0]["label"]
             block = block[1:]
         else:
-            # Make up a new name for this anonymous block.
-            name = fresh("b", by_name)
+            # Make up a new name for this anonymous block, as
+            # `fresh("b", by_name)` would. Names are only ever added, so
+            # the first free number never goes down: carry on from the
+            # last one rather than probing from 1 again.
+            while "b" + str(n) in by_name:
+                n += 1
+            name = "b" + str(n)
 
         # Add the block to the mapping.
         by_name[name] = block
@@ -49,21 +55,15 @@ def add_terminators(blocks):
     """Given an ordered block map, modify the blocks to add terminators
     to all blocks (avoiding "fall-through" control flow transfers).
     """
+    names = list(blocks.keys())
     for i, block in enumerate(blocks.values()):
-        if not block:
-            if i == len(blocks) - 1:
+        if not block or block[-1]["op"] not in TERMINATORS:
+            if i == len(names) - 1:
                 # In the last block, return.
                 block.append({"op": "ret", "args": []})
-            else:
-                dest = list(blocks.keys())[i + 1]
-                block.append({"op": "jmp", "labels": [dest]})
-        elif block[-1]["op"] not in TERMINATORS:
-            if i == len(blocks) - 1:
-                block.append({"op": "ret", "args": []})
             else:
                 # Otherwise, jump to the next block.
-                dest = list(blocks.keys())[i + 1]
-                block.append({"op": "jmp", "labels": [dest]})
+                block.append({"op": "jmp", "labels": [names[i + 1]]})
 
 
 def add_entry(blocks):
@@ -76,10 +76,8 @@ def add_entry(blocks):
     first_lbl = next(iter(blocks.keys()))
 
     # Check for any references to the label.
-    for instr in flatten(blocks.values()):
-        if "labels" in instr and first_lbl in instr["labels"]:
-            break
-    else:
+    if not any(first_lbl in instr.get("labels", ())
+               for block in blocks.values() for instr in block):
         return
 
     # References exist; insert a new block.
@@ -102,6 +100,20 @@ def edges(blocks):
     return preds, succs
 
 
+def build_cfg(instrs, entry=True):
+    """Build the CFG of a function's instructions: its block map, with a
+    unique entry block added by `add_entry` (unless `entry` is false)
+    and terminators by `add_terminators`, and the successor and
+    predecessor maps of `edges`. Returns (blocks, succs, preds).
+    """
+    blocks = block_map(form_blocks(instrs))
+    if entry and blocks:
+        add_entry(blocks)
+    add_terminators(blocks)
+    preds, succs = edges(blocks)
+    return blocks, succs, preds
+
+
 def reassemble(blocks):
     """Flatten a CFG into an instruction list."""
     # This could optimize slightly by opportunistically eliminating
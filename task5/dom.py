@@ -1,34 +1,20 @@
 import json
+import os
 import sys
-from cfg import block_map, successors, add_terminators, add_entry
-from form_blocks import form_blocks
+from cfg import build_cfg
+
+# traversal.py is shared from task4, the one directory that has it.
+TASK4 = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "task4")
+if TASK4 not in sys.path:
+    sys.path.append(TASK4)
+from traversal import reverse_postorder
 
 
 def dom(bril, mode="dom"):
     for fn in bril["functions"]:
-        blocks = block_map(form_blocks(fn["instrs"]))
-        add_entry(blocks)
-        add_terminators(blocks)
-        next_map = {blk: successors(instrs[-1]) for blk, instrs in blocks.items()}
-
-        pred_map = {k: [] for k in next_map}
-        for parent, children in next_map.items():
-            for child in children:
-                pred_map[child].append(parent)
-
-        visited = set()
-        post_order = []
-
-        def dfs(node):
-            if node in visited:
-                return
-            visited.add(node)
-            for nxt in next_map[node]:
-                dfs(nxt)
-            post_order.append(node)
+        blocks, next_map, pred_map = build_cfg(fn["instrs"])
 
-        dfs(list(blocks.keys())[0])
-        rev_post = list(reversed(post_order))
+        rev_post = reverse_postorder(next_map, next(iter(blocks)))
 
         doms = {n: set(rev_post) for n in next_map}
 
@@ -0,0 +1,158 @@
+"""An on-disk cache of per-function pass results.
+
+A result is stored under a hash of the pass's name, its version and the
+canonical JSON of the function it was run on, so a function that has
+not changed since the last run gets its result back without running
+the pass. The version is normally `code_version` of the pass's source,
+which changes whenever any of the code it could depend on does.
+
+Entries are files under the cache directory. Reading an entry touches
+it, and `evict` deletes the least recently used entries once the cache
+is over its size cap. Entries are written to a temporary file and
+renamed into place, so several processes can share a cache. Temporary
+files start with TMP_PREFIX, which no key does, and `evict` leaves them
+alone so it cannot pull a file out from under a writer.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "bril-passes")
+
+MISS = object()
+
+TMP_PREFIX = ".tmp-"
+
+
+def code_version(*paths):
+    """A hash of source code: every .py file in each directory given,
+    and any other file as it is.
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".py"))
+        else:
+            files = [path]
+        for name in files:
+            with open(name, "rb") as f:
+                h.update(os.path.basename(name).encode() + b"\0" + f.read() + b"\0")
+    return h.hexdigest()[:16]
+
+
+class PassCache:
+    def __init__(self, directory=DEFAULT_DIR, max_bytes=256 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, name, version, func):
+        text = json.dumps(func, sort_keys=True, separators=(",", ":"))
+        h = hashlib.sha256("{}\0{}\0".format(name, version).encode())
+        h.update(text.encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """The stored result, or MISS."""
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            # Missing, evicted by another process, or half-written.
+            return MISS
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=TMP_PREFIX)
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(value, f, separators=(",", ":"))
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in
+        `max_bytes`. Returns how many were deleted.
+        """
+        entries = []
+        total = 0
+        try:
+            subdirs = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            return 0
+        for sub in subdirs:
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.startswith(TMP_PREFIX):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        entries.sort()
+        deleted = 0
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            deleted += 1
+        return deleted
+
+
+class Cached:
+    """A per-function transform with its results kept in a PassCache.
+    It pickles, so it can be handed to `map_functions` with jobs.
+    """
+
+    def __init__(self, transform, name, version, cache):
+        self.transform = transform
+        self.name = name
+        self.version = version
+        self.cache = cache
+
+    def __call__(self, func):
+        # The key is taken first: transforms may change func in place.
+        key = self.cache.key(self.name, self.version, func)
+        result = self.cache.get(key)
+        if result is MISS:
+            result = self.transform(func)
+            self.cache.put(key, result)
+        return result
+
+
+def cached(transform, name, cache, *sources):
+    """`transform`, cached in `cache` under a version taken from
+    `sources`; or just `transform` if `cache` is None.
+    """
+    if cache is None:
+        return transform
+    return Cached(transform, name, code_version(*sources), cache)
+
+
+def cache_arg(args):
+    """The PassCache chosen by `--cache DIR` (and `--cache-mb N` for its
+    size cap) in a command line, if any.
+    """
+    if "--cache" not in args:
+        return None
+    cache = PassCache(args[args.index("--cache") + 1])
+    if "--cache-mb" in args:
+        cache.max_bytes = int(args[args.index("--cache-mb") + 1]) << 20
+    return cache
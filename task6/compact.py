@@ -0,0 +1,239 @@
+"""A compact, array-backed form of Bril programs.
+
+Each function is a table with one row per instruction or label, stored
+as parallel `array('i')` columns of interned ids: opcode, destination,
+type, and offsets into flat columns of argument, label and function
+ids. Basic blocks are ranges of rows and the CFG is lists of block
+indices, so analyses can work on ints throughout; compact_dce.py, which
+`passes.py dce` runs, is one. Converting to and from Bril JSON is
+lossless: keys the table has no column for are kept on the side.
+"""
+
+import json
+import sys
+from array import array
+
+from bitvec import Interner
+from form_blocks import TERMINATORS
+
+# The opcode id of label rows.
+LABEL = -1
+
+# Bits of the `has` column: which optional keys an instruction has.
+HAS_ARGS, HAS_LABELS, HAS_FUNCS, HAS_VALUE = 1, 2, 4, 8
+
+KNOWN = {"op", "dest", "type", "args", "labels", "funcs", "value", "label"}
+
+
+class CompactProgram:
+    """The functions of a program, sharing one set of interners: `ops`
+    for opcodes, `names` for variables, labels and function names, and
+    `types` for types (keyed by their JSON text, since a type can be an
+    object like {"ptr": "int"}).
+    """
+
+    def __init__(self, bril=None):
+        self.ops = Interner()
+        self.names = Interner()
+        self.types = Interner()
+        self.functions = []
+        self.header = {}  # Top-level keys other than "functions".
+        # Interned up front so that queries only ever look them up.
+        self._terminators = frozenset(self.ops.add(op) for op in TERMINATORS)
+        if bril is not None:
+            self.header = {k: v for k, v in bril.items() if k != "functions"}
+            for func in bril["functions"]:
+                self.functions.append(CompactFunction(self, func))
+
+    def terminators(self):
+        return self._terminators
+
+    def to_json(self):
+        bril = dict(self.header)
+        bril["functions"] = [f.to_json() for f in self.functions]
+        return bril
+
+
+class CompactFunction:
+    """One function as columns of ints, one entry per row.
+
+    `op`, `dest` and `type` hold interned ids, with -1 for none (and
+    `op` is LABEL on label rows, whose name goes in `dest`). The
+    arguments of row i are `args[arg_at[i]:arg_at[i + 1]]`, and likewise
+    for `labels`/`label_at` and `funcs`/`func_at`. Const values are in
+    the `values` list at index `value[i]`.
+    """
+
+    def __init__(self, program, func=None):
+        self.program = program
+        self.header = {}  # The function's keys other than "instrs".
+        self.op = array("i")
+        self.dest = array("i")
+        self.type = array("i")
+        self.has = array("b")
+        self.value = array("i")
+        self.values = []
+        self.args = array("i")
+        self.arg_at = array("i", [0])
+        self.labels = array("i")
+        self.label_at = array("i", [0])
+        self.funcs = array("i")
+        self.func_at = array("i", [0])
+        self.extra = {}  # Row -> keys without a column.
+        if func is not None:
+            self.header = {k: v for k, v in func.items() if k != "instrs"}
+            for instr in func["instrs"]:
+                self.append(instr)
+
+    def __len__(self):
+        return len(self.op)
+
+    def append(self, instr):
+        """Add an instruction or label as a new row; returns its index."""
+        p = self.program
+        row = len(self.op)
+        has = 0
+        if "label" in instr:
+            self.op.append(LABEL)
+            self.dest.append(p.names.add(instr["label"]))
+        else:
+            self.op.append(p.ops.add(instr["op"]))
+            self.dest.append(p.names.add(instr["dest"]) if "dest" in instr else -1)
+        self.type.append(p.types.add(json.dumps(instr["type"])) if "type" in instr else -1)
+
+        if "value" in instr:
+            has |= HAS_VALUE
+            self.value.append(len(self.values))
+            self.values.append(instr["value"])
+        else:
+            self.value.append(-1)
+        for key, bit, column, offsets in (
+            ("args", HAS_ARGS, self.args, self.arg_at),
+            ("labels", HAS_LABELS, self.labels, self.label_at),
+            ("funcs", HAS_FUNCS, self.funcs, self.func_at),
+        ):
+            if key in instr:
+                has |= bit
+                column.extend(p.names.add(name) for name in instr[key])
+            offsets.append(len(column))
+        self.has.append(has)
+
+        extra = {k: v for k, v in instr.items() if k not in KNOWN}
+        if extra:
+            self.extra[row] = extra
+        return row
+
+    def uses(self, row):
+        return self.args[self.arg_at[row]:self.arg_at[row + 1]]
+
+    def targets(self, row):
+        return self.labels[self.label_at[row]:self.label_at[row + 1]]
+
+    def instr(self, row):
+        """Rebuild the Bril JSON for one row."""
+        p = self.program
+        names = p.names.names
+        if self.op[row] == LABEL:
+            instr = {"label": names[self.dest[row]]}
+        else:
+            instr = {"op": p.ops.names[self.op[row]]}
+            if self.dest[row] >= 0:
+                instr["dest"] = names[self.dest[row]]
+        if self.type[row] >= 0:
+            instr["type"] = json.loads(p.types.names[self.type[row]])
+        has = self.has[row]
+        if has & HAS_ARGS:
+            instr["args"] = [names[n] for n in self.uses(row)]
+        if has & HAS_LABELS:
+            instr["labels"] = [names[n] for n in self.targets(row)]
+        if has & HAS_FUNCS:
+            instr["funcs"] = [names[n] for n in self.funcs[self.func_at[row]:self.func_at[row + 1]]]
+        if has & HAS_VALUE:
+            instr["value"] = self.values[self.value[row]]
+        if row in self.extra:
+            instr.update(self.extra[row])
+        return instr
+
+    def to_json(self):
+        func = dict(self.header)
+        func["instrs"] = [self.instr(row) for row in range(len(self.op))]
+        return func
+
+    def block_ranges(self):
+        """Split the rows into basic blocks the way `form_blocks` does,
+        as (start, end) ranges. A block's label row is part of it.
+        """
+        terminators = self.program.terminators()
+        ranges = []
+        start = 0
+        for row, op in enumerate(self.op):
+            if op == LABEL:
+                if row > start:
+                    ranges.append((start, row))
+                start = row
+            elif op in terminators:
+                ranges.append((start, row + 1))
+                start = row + 1
+        if len(self.op) > start:
+            ranges.append((start, len(self.op)))
+        return ranges
+
+    def block_names(self, ranges):
+        """Name blocks like `cfg.block_map`: by their label, or else a
+        fresh "b" name.
+        """
+        out = []
+        taken = set()
+        n = 1
+        for start, _ in ranges:
+            if self.op[start] == LABEL:
+                name = self.program.names.names[self.dest[start]]
+            else:
+                # Names are only ever added, so the first free number
+                # never goes down; carry on from the last one.
+                while "b{}".format(n) in taken:
+                    n += 1
+                name = "b{}".format(n)
+            taken.add(name)
+            out.append(name)
+        return out
+
+    def edges(self, ranges):
+        """Predecessor and successor lists of block indices, as
+        `cfg.edges` finds them once `cfg.add_terminators` has run: a
+        block without a terminator falls through to the next one, or
+        returns if it is the last.
+        """
+        p = self.program
+        jumps = {p.ops["jmp"], p.ops["br"]}
+        ret = p.ops["ret"]
+        block_of = {}
+        for i, (start, _) in enumerate(ranges):
+            if self.op[start] == LABEL:
+                block_of[self.dest[start]] = i
+
+        preds = [[] for _ in ranges]
+        succs = [[] for _ in ranges]
+        for i, (start, end) in enumerate(ranges):
+            last = end - 1
+            op = self.op[last]
+            if op in jumps:
+                out = [block_of[label] for label in self.targets(last)]
+            elif op == ret or i + 1 == len(ranges):
+                out = []
+            else:
+                out = [i + 1]
+            for s in out:
+                succs[i].append(s)
+                preds[s].append(i)
+        return preds, succs
+
+
+def from_json(bril):
+    return CompactProgram(bril)
+
+
+if __name__ == "__main__":
+    # Round-trip a program through the compact form.
+    bril = json.load(sys.stdin)
+    json.dump(from_json(bril).to_json(), sys.stdout, indent=2, sort_keys=True)
@@ -0,0 +1,124 @@
+"""Global dead code elimination over the compact IR of compact.py.
+
+This removes what task4/dce.py removes, but its analysis reads the
+integer columns of a `CompactFunction` instead of instruction dicts:
+variables are name ids, so a set of them is a bitmask with no interning
+step, and blocks are row ranges. Only the final sweep touches the
+original instructions, to pick out the rows that stay.
+
+The analysis is strong (faint variable) liveness: a variable is live
+only if a live instruction reads it. Instructions that define nothing,
+and calls, are live. Unlike plain liveness this also drops definitions
+that only feed each other around a loop, as the mark and sweep of
+task4/dce.py does.
+"""
+
+import json
+import sys
+
+from compact import CompactProgram, LABEL
+
+# Instructions that must stay even if their result is never used.
+SIDE_EFFECTS = ("call",)
+
+
+def row_masks(cf):
+    """The (defs, uses) bitmasks of every row of a CompactFunction.
+
+    `set x y` writes the shadow of x that a later `get x` reads. The
+    shadow of the variable with id n is bit `shadow + n`, past every
+    real variable.
+    """
+    p = cf.program
+    shadow = len(p.names)
+    set_op = p.ops.get("set")
+    get_op = p.ops.get("get")
+    defs = [0] * len(cf)
+    uses = [0] * len(cf)
+    for row in range(len(cf)):
+        op = cf.op[row]
+        if op == LABEL:
+            continue
+        args = cf.uses(row)
+        if op == set_op:
+            defs[row] = 1 << (shadow + args[0])
+            args = args[1:]
+        elif op == get_op:
+            defs[row] = 1 << cf.dest[row]
+            uses[row] = 1 << (shadow + cf.dest[row])
+            continue
+        elif cf.dest[row] >= 0:
+            defs[row] = 1 << cf.dest[row]
+        mask = 0
+        for n in args:
+            mask |= 1 << n
+        uses[row] = mask
+    return defs, uses
+
+
+def dead_rows(cf):
+    """The set of rows of a CompactFunction that are dead."""
+    ranges = cf.block_ranges()
+    preds, succs = cf.edges(ranges)
+    defs, uses = row_masks(cf)
+    keep = {cf.program.ops[op] for op in SIDE_EFFECTS if op in cf.program.ops}
+
+    def transfer(i, live, dead=None):
+        start, end = ranges[i]
+        for row in range(end - 1, start - 1, -1):
+            d = defs[row]
+            if d and not live & d and cf.op[row] not in keep:
+                if dead is not None:
+                    dead.add(row)
+                continue
+            live = live & ~d | uses[row]
+        return live
+
+    live_in = [0] * len(ranges)
+    live_out = [0] * len(ranges)
+    work = list(range(len(ranges)))
+    queued = [True] * len(ranges)
+    while work:
+        i = work.pop()
+        queued[i] = False
+        out = 0
+        for s in succs[i]:
+            out |= live_in[s]
+        live_out[i] = out
+        new = transfer(i, out)
+        if new != live_in[i]:
+            live_in[i] = new
+            for p in preds[i]:
+                if not queued[p]:
+                    queued[p] = True
+                    work.append(p)
+
+    dead = set()
+    for i in range(len(ranges)):
+        transfer(i, live_out[i], dead)
+    return dead
+
+
+def dce_func(func):
+    """Remove dead instructions from a function in place. Returns the
+    number of instructions removed.
+    """
+    # A program of its own keeps the function's name ids, and so its
+    # bitmasks, dense.
+    cf = CompactProgram({"functions": [func]}).functions[0]
+    dead = dead_rows(cf)
+    if dead:
+        func["instrs"] = [instr for row, instr in enumerate(func["instrs"])
+                          if row not in dead]
+    return len(dead)
+
+
+def dce(bril):
+    for func in bril["functions"]:
+        dce_func(func)
+
+
+if __name__ == "__main__":
+    bril = json.load(sys.stdin)
+    dce(bril)
+    json.dump(bril, sys.stdout, indent=2, sort_keys=True)
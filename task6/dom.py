@@ -1,8 +1,17 @@
 import json
+import os
 import sys
+from functools import partial
 
-from cfg import block_map, successors, add_terminators, add_entry
-from form_blocks import form_blocks
+from cfg import build_cfg
+from stream import parallel_map, read_functions
+from cache import cache_arg, cached
+
+# traversal.py is shared from task4, the one directory that has it.
+TASK4 = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "task4")
+if TASK4 not in sys.path:
+    sys.path.append(TASK4)
+from traversal import traverse
 
 
 def map_inv(succ):
@@ -18,56 +27,147 @@ def map_inv(succ):
     return out
 
 
-def postorder_helper(succ, root, explored, out):
-    """Given a successor edge map, produce a list of all the nodes in
-    the graph in postorder by appending to the `out` list.
-    """
-    if root in explored:
-        return
-    explored.add(root)
+class Dominators:
+    """Immediate dominators of a CFG, computed with the iterative
+    algorithm from Cooper, Harvey and Kennedy's "A Simple, Fast
+    Dominance Algorithm".
 
-    for s in succ[root]:
-        postorder_helper(succ, s, explored, out)
-    out.append(root)
+    Reachable blocks are numbered in reverse postorder and `idom` is an
+    integer array over those numbers: `idom[i]` is the number of the
+    immediate dominator of block `order[i]`, and the entry is its own
+    immediate dominator. Unreachable blocks get no number; as in the
+    set-based formulation, they are (vacuously) dominated by every
+    reachable block.
 
+    The dominator tree is kept as `children` adjacency lists over the
+    same numbers, together with preorder and postorder numbers (`pre`
+    and `post`) from a walk of the tree, so that dominance queries are
+    an interval check.
 
-def postorder(succ, root):
-    out = []
-    postorder_helper(succ, root, set(), out)
-    return out
+    The depth-first `traversal` the numbering comes from is kept with
+    the CFG it was computed from, for anything else that needs it.
+    """
 
+    def __init__(self, succ, entry):
+        self.succ = succ
+        self.pred = map_inv(succ)
+        self.traversal = traverse(succ, entry)
+        self.order = [self.traversal.names[i] for i in self.traversal.rpo]
+        self.index = {name: i for i, name in enumerate(self.order)}
+        self.idom = self._compute_idom()
+
+        self.children = [[] for _ in self.order]
+        for i in range(1, len(self.idom)):
+            self.children[self.idom[i]].append(i)
+        self.pre, self.post = self._number_tree()
+
+        self._dom = None
+
+    def _compute_idom(self):
+        index = self.index
+        # Predecessor lists over block numbers, ignoring unreachable blocks.
+        preds = [
+            [index[p] for p in self.pred[name] if p in index]
+            for name in self.order
+        ]
 
-def intersect(sets):
-    sets = list(sets)
-    if not sets:
-        return set()
-    out = set(sets[0])
-    for s in sets[1:]:
-        out &= s
-    return out
+        idom = [-1] * len(self.order)
+        idom[0] = 0
+
+        def intersect(b1, b2):
+            # Walk both fingers up the tree until they meet. Dominators
+            # always have smaller reverse-postorder numbers.
+            while b1 != b2:
+                while b1 > b2:
+                    b1 = idom[b1]
+                while b2 > b1:
+                    b2 = idom[b2]
+            return b1
+
+        changed = True
+        while changed:
+            changed = False
+            for i in range(1, len(idom)):
+                new_idom = -1
+                for p in preds[i]:
+                    if idom[p] == -1:
+                        continue  # Not processed yet.
+                    new_idom = p if new_idom == -1 else intersect(p, new_idom)
+
+                if idom[i] != new_idom:
+                    idom[i] = new_idom
+                    changed = True
+
+        return idom
+
+    def _number_tree(self):
+        pre = [0] * len(self.order)
+        post = [0] * len(self.order)
+        pre_count = post_count = 0
+
+        # Walk the tree with an explicit stack of (node, next child) pairs.
+        stack = [(0, 0)]
+        pre[0] = pre_count
+        pre_count += 1
+        while stack:
+            node, i = stack[-1]
+            kids = self.children[node]
+            if i < len(kids):
+                stack[-1] = (node, i + 1)
+                child = kids[i]
+                pre[child] = pre_count
+                pre_count += 1
+                stack.append((child, 0))
+            else:
+                stack.pop()
+                post[node] = post_count
+                post_count += 1
+
+        return pre, post
+
+    def immediate(self, name):
+        """Get the name of the immediate dominator of a block, or None for
+        the entry and for unreachable blocks.
+        """
+        i = self.index.get(name)
+        if not i:
+            return None
+        return self.order[self.idom[i]]
+
+    def dominates(self, a, b):
+        """Check whether block `a` dominates block `b`."""
+        ia = self.index.get(a)
+        if ia is None:
+            return False
+        ib = self.index.get(b)
+        if ib is None:
+            return True  # Unreachable blocks are dominated by everything.
+
+        # `a` dominates `b` iff b's subtree interval nests inside a's.
+        return self.pre[ia] <= self.pre[ib] and self.post[ib] <= self.post[ia]
+
+    @property
+    def dom(self):
+        """The full dominance relation, mapping each block to the set of
+        blocks that dominate it. Built on first use.
+        """
+        if self._dom is None:
+            dom = {}
+            for i, name in enumerate(self.order):
+                if i == 0:
+                    dom[name] = {name}
+                else:
+                    dom[name] = dom[self.order[self.idom[i]]] | {name}
+
+            reachable = set(self.order)
+            self._dom = {
+                v: dom[v] if v in dom else set(reachable) for v in self.succ
+            }
+        return self._dom
 
 
 def get_dom(succ, entry):
-    pred = map_inv(succ)
-    nodes = list(reversed(postorder(succ, entry)))  # Reverse postorder.
-
-    dom = {v: set(nodes) for v in succ}
-
-    while True:
-        changed = False
-
-        for node in nodes:
-            new_dom = intersect(dom[p] for p in pred[node])
-            new_dom.add(node)
-
-            if dom[node] != new_dom:
-                dom[node] = new_dom
-                changed = True
-
-        if not changed:
-            break
-
-    return dom
+    return Dominators(succ, entry).dom
 
 
 def dom_fronts(dom, succ):
@@ -90,6 +190,99 @@ def dom_fronts(dom, succ):
     return frontiers
 
 
+def idom_fronts(doms):
+    """Compute the dominance frontier from immediate dominators.
+
+    For every edge p -> b, walk up the dominator tree from p until
+    reaching the immediate dominator of b; every block on the way has b
+    in its frontier. This touches each frontier entry once instead of
+    inverting the whole dominance relation.
+    """
+    order, index, idom = doms.order, doms.index, doms.idom
+    fronts = [[] for _ in order]
+
+    for ib, b in enumerate(order):
+        # The entry has no immediate dominator, so walk all the way up.
+        stop = idom[ib] if ib else -1
+        for p in doms.pred[b]:
+            runner = index.get(p)
+            if runner is None:
+                # An unreachable predecessor is dominated by every
+                # reachable block, so b is in the frontier of everything
+                # that does not strictly dominate it.
+                for ia in range(len(order)):
+                    if ia == ib or not doms.dominates(order[ia], b):
+                        if not fronts[ia] or fronts[ia][-1] != b:
+                            fronts[ia].append(b)
+                continue
+
+            while runner != stop:
+                if fronts[runner] and fronts[runner][-1] == b:
+                    break  # Already walked this path for b.
+                fronts[runner].append(b)
+                if runner == 0:
+                    break
+                runner = idom[runner]
+
+    # Unreachable blocks dominate nothing, so their frontiers are empty.
+    return {
+        name: fronts[index[name]] if name in index else []
+        for name in doms.succ
+    }
+
+
+def idom_tree(doms):
+    """Produce the dominator tree, mapping each block to the set of blocks
+    it immediately dominates, from the `children` lists of a
+    `Dominators`.
+    """
+    order = doms.order
+    tree = {}
+    for name in doms.succ:
+        i = doms.index.get(name)
+        if i is None:
+            tree[name] = set()
+        else:
+            tree[name] = {order[c] for c in doms.children[i]}
+
+    # The set-based construction hangs unreachable blocks, which every
+    # reachable block dominates, under each leaf of the tree. Keep that
+    # shape so the output does not change.
+    unreachable = [name for name in doms.succ if name not in doms.index]
+    if unreachable:
+        for i, kids in enumerate(doms.children):
+            if not kids:
+                tree[order[i]].update(unreachable)
+
+    return tree
+
+
+class DominanceInfo(Dominators):
+    """Dominators of a CFG bundled with the predecessor map, dominance
+    frontiers and dominator tree, so passes that need several of them
+    (like SSA conversion) compute each one only once.
+    """
+
+    def __init__(self, succ, entry):
+        super().__init__(succ, entry)
+        self._frontiers = None
+        self._tree = None
+
+    @property
+    def frontiers(self):
+        """The dominance frontier of every block. Built on first use."""
+        if self._frontiers is None:
+            self._frontiers = idom_fronts(self)
+        return self._frontiers
+
+    @property
+    def tree(self):
+        """The dominator tree, as built by `idom_tree`. Built on first use."""
+        if self._tree is None:
+            self._tree = idom_tree(self)
+        return self._tree
+
+
 def dom_tree(dom):
     # Get the blocks strictly dominated by a block strictly dominated by
     # a given block.
@@ -105,30 +298,54 @@ def dom_tree(dom):
     }
 
 
-def print_dom(bril, mode):
-    for func in bril["functions"]:
-        blocks = block_map(form_blocks(func["instrs"]))
-        add_entry(blocks)
-        add_terminators(blocks)
-        succ = {name: successors(block[-1]) for name, block in blocks.items()}
-        dom = get_dom(succ, list(blocks.keys())[0])
-
-        if mode == "front":
-            res = dom_fronts(dom, succ)
-        elif mode == "tree":
-            res = dom_tree(dom)
-        else:
-            res = dom
-
-        # Format as JSON for stable output.
-        print(
-            json.dumps(
-                {k: sorted(list(v)) for k, v in res.items()},
-                indent=2,
-                sort_keys=True,
-            )
-        )
+def format_dom(func, mode):
+    blocks, succ, _ = build_cfg(func["instrs"])
+    if not blocks:
+        return json.dumps({})  # An empty function has no blocks to dominate.
+    info = DominanceInfo(succ, next(iter(blocks)))
+
+    if mode == "front":
+        res = info.frontiers
+    elif mode == "tree":
+        res = info.tree
+    else:
+        res = info.dom
+
+    # Format as JSON for stable output.
+    return json.dumps(
+        {k: sorted(list(v)) for k, v in res.items()},
+        indent=2,
+        sort_keys=True,
+    )
+
+
+def print_dom(bril, mode, jobs=None, cache=None):
+    fmt = cached(partial(format_dom, mode=mode), "dom " + mode, cache,
+                 os.path.dirname(os.path.abspath(__file__)),
+                 os.path.join(TASK4, "traversal.py"))
+    if jobs:
+        # Functions are formatted in parallel and printed in order.
+        texts = parallel_map(fmt, bril["functions"], jobs)
+    else:
+        texts = map(fmt, bril["functions"])
+    for text in texts:
+        print(text)
 
 
 if __name__ == "__main__":
-    print_dom(json.load(sys.stdin), "dom" if len(sys.argv) < 2 else sys.argv[1])
+    args = sys.argv[1:]
+    jobs = int(args[args.index("--jobs") + 1]) if "--jobs" in args else None
+    cache = cache_arg(args)
+    options = {"--jobs", "--cache", "--cache-mb"}
+    modes = [
+        a for i, a in enumerate(args)
+        if not a.startswith("--") and (i == 0 or args[i - 1] not in options)
+    ]
+    mode = modes[0] if modes else "dom"
+    if "--stream" in args:
+        # Print each function's result as soon as it has been read.
+        print_dom({"functions": read_functions(sys.stdin)}, mode, jobs, cache)
+    else:
+        print_dom(json.load(sys.stdin), mode, jobs, cache)
+    if cache:
+        cache.evict()
@@ -0,0 +1,101 @@
+"""Profile-guided basic block layout.
+
+Blocks are linked into chains along their hottest edges, so that hot
+jumps can become fall-throughs, and then `jmp .next` terminators made
+redundant by the new order are dropped. The profile is the JSON written
+by the tracer's --profile option; without one the order is kept and
+only redundant terminators go.
+"""
+
+import json
+import sys
+from collections import OrderedDict
+
+from cfg import block_map, add_terminators, reassemble
+from form_blocks import form_blocks
+
+
+def chains(blocks, edges):
+    """Greedily link the blocks of a function into chains, taking edges
+    from hottest to coldest and joining a chain's tail to another
+    chain's head. Returns the chains in the order their first block
+    appears in the function, so the entry chain comes first.
+
+    Only an unconditional jump can turn into a fall-through: a branch
+    always names both of its targets. Jump edges are therefore taken
+    before branch edges, which only serve to keep hot code together.
+    """
+    names = list(blocks)
+    entry = names[0]
+    order = {name: i for i, name in enumerate(names)}
+
+    candidates = []
+    for src, out in edges.items():
+        if src not in blocks:
+            continue
+        jump = blocks[src][-1]["op"] == "jmp"
+        for dst, count in out.items():
+            if count > 0 and dst in blocks and dst != entry and dst != src:
+                candidates.append((not jump, -count, order[src], order[dst], src, dst))
+    candidates.sort()
+
+    chain_of = {name: [name] for name in names}
+    for *_, src, dst in candidates:
+        a, b = chain_of[src], chain_of[dst]
+        if a is b or a[-1] != src or b[0] != dst:
+            continue
+        a.extend(b)
+        for name in b:
+            chain_of[name] = a
+
+    out = []
+    seen = set()
+    for name in names:
+        chain = chain_of[name]
+        if id(chain) not in seen:
+            seen.add(id(chain))
+            out.append(chain)
+    return out
+
+
+def layout(func, profile=None):
+    """Reorder a function's blocks in place. `profile` is the function's
+    entry in a tracer profile, with an "edges" map of block to
+    {successor: count}.
+    """
+    blocks = block_map(form_blocks(func["instrs"]))
+    if not blocks:
+        return
+    add_terminators(blocks)
+
+    edges = profile["edges"] if profile else {}
+    order = [name for chain in chains(blocks, edges) for name in chain]
+    laid = OrderedDict((name, blocks[name]) for name in order)
+
+    for name, nxt in zip(order, order[1:]):
+        block = laid[name]
+        if block and block[-1]["op"] == "jmp" and block[-1]["labels"][0] == nxt:
+            block.pop()
+
+    # Falling off the end of a function returns.
+    last = laid[order[-1]]
+    if last and last[-1]["op"] == "ret" and not last[-1].get("args"):
+        last.pop()
+
+    func["instrs"] = reassemble(laid)
+
+
+def layout_program(bril, profile=None):
+    functions = profile["functions"] if profile else {}
+    for func in bril["functions"]:
+        layout(func, functions.get(func["name"]))
+    return bril
+
+
+if __name__ == "__main__":
+    profile = None
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as f:
+            profile = json.load(f)
+    bril = json.load(sys.stdin)
+    json.dump(layout_program(bril, profile), sys.stdout, indent=2, sort_keys=True)
@@ -0,0 +1,197 @@
+"""Run a chain of passes over a Bril program in one process.
+
+    python passes.py lvn dce ssa sccp layout=profile.json < in.json > out.json
+
+The program is parsed once, every pass works on the same in-memory
+program, and the result is serialized once; piping the single-pass
+filters together instead re-parses and re-serializes the whole program
+at each stage. The time spent parsing, in each pass and serializing is
+reported on stderr.
+
+With --stream, functions are read, run through every pass and written
+one at a time, so memory is bounded by the largest function rather than
+the whole program. All the passes here work a function at a time, so
+the output is the same. --jobs N also streams, and runs the passes over
+N functions at once in worker processes. --cache DIR (with --cache-mb N
+to cap its size) also streams, and keeps each function's result in DIR
+to reuse while the function, the passes and their code are unchanged.
+"""
+
+import importlib.util
+import json
+import os
+import sys
+import time
+
+from functools import partial
+
+from cache import cache_arg, cached
+from stream import map_functions, read_functions, write_functions
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+_loaded = {}
+
+
+def load(task, filename):
+    """Import a module from another task directory.
+
+    Task directories keep their own copies of helper modules under the
+    same names (dce.py, dom.py, cfg.py, ...), so the module is imported
+    with its own directory's copies, which are then taken out of
+    `sys.modules` again so they cannot shadow this directory's.
+    """
+    key = (task, filename)
+    if key in _loaded:
+        return _loaded[key]
+
+    directory = os.path.join(HERE, "..", task)
+    siblings = {os.path.splitext(f)[0] for f in os.listdir(directory) if f.endswith(".py")}
+    saved = {name: sys.modules.pop(name) for name in siblings if name in sys.modules}
+    sys.path.insert(0, directory)
+    try:
+        name = "{}.{}".format(task, os.path.splitext(filename)[0])
+        spec = importlib.util.spec_from_file_location(name, os.path.join(directory, filename))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+        for name in siblings:
+            sys.modules.pop(name, None)
+        sys.modules.update(saved)
+
+    _loaded[key] = module
+    return module
+
+
+def run_lvn(bril, arg):
+    load("task3", "test_lvn(4).py").start(bril)
+
+
+def run_dce(bril, arg):
+    # The same result as task4/dce.py, analyzed over the compact IR.
+    from compact_dce import dce
+    dce(bril)
+
+
+def run_ssa(bril, arg):
+    from to_ssa import ssa
+    return ssa(bril)
+
+
+def run_sccp(bril, arg):
+    from sccp import sccp
+    return sccp(bril)
+
+
+def run_layout(bril, arg):
+    from layout import layout_program
+    profile = None
+    if arg:
+        with open(arg) as f:
+            profile = json.load(f)
+    return layout_program(bril, profile)
+
+
+# Each pass takes the program and the argument after `=` in its name (or
+# None), and either changes the program in place or returns a new one.
+PASSES = {
+    "lvn": run_lvn,
+    "dce": run_dce,
+    "ssa": run_ssa,
+    "sccp": run_sccp,
+    "layout": run_layout,
+}
+
+
+def run_passes(bril, specs, timings=None):
+    """Run the named passes in order. `timings`, if given, maps each
+    pass to the seconds spent in it, added to what is already there.
+    """
+    for spec in specs:
+        name, _, arg = spec.partition("=")
+        before = time.perf_counter()
+        result = PASSES[name](bril, arg or None)
+        if result is not None:
+            bril = result
+        if timings is not None:
+            timings[spec] = timings.get(spec, 0.0) + time.perf_counter() - before
+    return bril
+
+
+def stream(specs, timings):
+    """Run the passes over stdin a function at a time, writing each
+    function to stdout once it is done.
+    """
+    def transformed(functions):
+        for func in functions:
+            yield run_passes({"functions": [func]}, specs, timings)["functions"][0]
+
+    before = time.perf_counter()
+    header = {}
+    write_functions(sys.stdout, transformed(read_functions(sys.stdin, header)), header)
+    sys.stdout.write("\n")
+    # Reading and writing are interleaved with the passes.
+    timings["(parse+dump)"] = time.perf_counter() - before - sum(timings.values())
+
+
+def run_function(specs, func):
+    return run_passes({"functions": [func]}, specs)["functions"][0]
+
+
+def main(args):
+    jobs = int(args[args.index("--jobs") + 1]) if "--jobs" in args else None
+    cache = cache_arg(args)
+    options = {"--jobs", "--cache", "--cache-mb"}
+    specs = [a for i, a in enumerate(args)
+             if not a.startswith("--") and (i == 0 or args[i - 1] not in options)]
+    unknown = [s for s in specs if s.partition("=")[0] not in PASSES]
+    if unknown:
+        raise SystemExit("unknown pass {}; passes are: {}".format(
+            ", ".join(unknown), ", ".join(PASSES)))
+
+    timings = {}
+    if jobs or cache:
+        # The passes run in the workers or are skipped for cached
+        # functions, so only the total is known here. The version covers
+        # the code of every task the passes come from and the files
+        # passes read, like layout's profile.
+        sources = [HERE] + [os.path.join(HERE, "..", task) for task in ("task3", "task4")]
+        sources += [s.partition("=")[2] for s in specs if s.partition("=")[2]]
+        transform = cached(partial(run_function, specs), " ".join(specs), cache, *sources)
+        before = time.perf_counter()
+        map_functions(transform, sys.stdin, sys.stdout, jobs)
+        sys.stdout.write("\n")
+        timings["(total)"] = time.perf_counter() - before
+        report(timings)
+        if cache:
+            cache.evict()
+        return
+    if "--stream" in args:
+        stream(specs, timings)
+        report(timings)
+        return
+
+    before = time.perf_counter()
+    bril = json.load(sys.stdin)
+    timings["(parse)"] = time.perf_counter() - before
+
+    bril = run_passes(bril, specs, timings)
+
+    before = time.perf_counter()
+    # One write: json.dump makes many small ones, which costs more than
+    # the encoding itself when stdout is a pipe.
+    sys.stdout.write(json.dumps(bril, indent=2, sort_keys=True))
+    sys.stdout.write("\n")
+    timings["(dump)"] = time.perf_counter() - before
+    report(timings)
+
+
+def report(timings):
+    width = max(len(name) for name in timings)
+    for name, seconds in timings.items():
+        print("{:<{}}  {:8.2f} ms".format(name, width, seconds * 1000), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,215 @@
+"""Sparse conditional constant propagation over the get/set SSA form
+produced by to_ssa.py.
+"""
+
+import json
+import sys
+from collections import defaultdict
+
+from cfg import block_map, successors, add_terminators, reassemble
+from form_blocks import form_blocks
+from fold import FOLD
+
+# Lattice values besides constants: nothing known yet, and known not to
+# be a constant.
+TOP = object()
+BOTTOM = object()
+
+
+def meet(a, b):
+    if a is TOP:
+        return b
+    if b is TOP:
+        return a
+    if a is BOTTOM or b is BOTTOM or a != b or type(a) is not type(b):
+        return BOTTOM
+    return a
+
+
+def evaluate(instr, value):
+    """Compute the lattice value of a (non-get) instruction's result."""
+    op = instr["op"]
+    if op == "const":
+        return instr["value"]
+    if op == "id":
+        return value(instr["args"][0])
+    if op == "undef":
+        return TOP
+    if op not in FOLD:
+        return BOTTOM
+
+    vals = [value(a) for a in instr["args"]]
+    if any(v is BOTTOM for v in vals):
+        return BOTTOM
+    if any(v is TOP for v in vals):
+        return TOP
+    if op == "div" and vals[1] == 0:
+        return BOTTOM  # Leave the trap to run time.
+    return FOLD[op](*vals)
+
+
+class SCCP:
+    """The SCCP solver for one function, whose blocks are in get/set SSA
+    form with explicit terminators.
+
+    Two worklists drive the analysis: CFG edges that have just become
+    executable, and instructions whose operands have just changed. A
+    variable's value only moves down the lattice (TOP, then a constant,
+    then BOTTOM), so each def-use edge is followed at most twice.
+    """
+
+    def __init__(self, blocks, params=()):
+        self.blocks = blocks
+        self.values = defaultdict(lambda: TOP)
+        for param in params:
+            self.values[param] = BOTTOM
+        self.executable = set()  # Blocks.
+        self.edges = set()  # (pred, succ) pairs.
+        self.top_branches = []  # brs visited while their condition was TOP.
+
+        # Def-use chains, and where each instruction lives.
+        self.uses = defaultdict(list)
+        self.home = {}
+        self.gets = {}  # get dest -> the get instruction.
+        self.get_block = {}  # get dest -> block of the get.
+        self.sets = defaultdict(list)  # get dest -> [(block, set instr)].
+        for name, block in blocks.items():
+            for instr in block:
+                self.home[id(instr)] = name
+                if instr["op"] == "get":
+                    self.gets[instr["dest"]] = instr
+                    self.get_block[instr["dest"]] = name
+                elif instr["op"] == "set":
+                    self.sets[instr["args"][0]].append((name, instr))
+                    self.uses[instr["args"][1]].append(instr)
+                    continue
+                for arg in instr.get("args", []):
+                    self.uses[arg].append(instr)
+
+    def value(self, var):
+        return self.values[var]
+
+    def run(self):
+        entry = next(iter(self.blocks))
+        self.cfg_work = [(None, entry)]
+        self.ssa_work = []
+        while True:
+            while self.cfg_work or self.ssa_work:
+                while self.cfg_work:
+                    pred, name = self.cfg_work.pop()
+                    if (pred, name) in self.edges:
+                        continue
+                    self.edges.add((pred, name))
+                    if name in self.executable:
+                        # A new way in: only the gets can change.
+                        for instr in self.blocks[name]:
+                            if instr["op"] == "get":
+                                self.visit(instr)
+                    else:
+                        self.executable.add(name)
+                        for instr in self.blocks[name]:
+                            self.visit(instr)
+                while self.ssa_work:
+                    instr = self.ssa_work.pop()
+                    if self.home[id(instr)] in self.executable:
+                        self.visit(instr)
+
+            # A br whose condition is still TOP (fed only by undef or by
+            # sets on edges never taken) has marked neither target, but it
+            # stays in the program, so its targets have to as well. Give
+            # up on the condition and let the solver take both edges.
+            stuck = [instr for instr in self.top_branches
+                     if self.values[instr["args"][0]] is TOP]
+            self.top_branches = []
+            if not stuck:
+                return self
+            for instr in stuck:
+                self.lower(instr["args"][0], BOTTOM)
+
+    def lower(self, var, val):
+        old = self.values[var]
+        new = meet(old, val)
+        if new is not old and (new is BOTTOM or old is TOP):
+            self.values[var] = new
+            self.ssa_work.extend(self.uses[var])
+
+    def visit(self, instr):
+        op = instr["op"]
+        name = self.home[id(instr)]
+        if op == "get":
+            val = TOP
+            for pred, s in self.sets[instr["dest"]]:
+                if (pred, name) in self.edges:
+                    val = meet(val, self.value(s["args"][1]))
+            self.lower(instr["dest"], val)
+        elif op == "set":
+            # Re-evaluate the get this set feeds.
+            target = self.gets.get(instr["args"][0])
+            if target is not None:
+                self.ssa_work.append(target)
+        elif op == "br":
+            cond = self.value(instr["args"][0])
+            if cond is BOTTOM:
+                targets = instr["labels"]
+            elif cond is TOP:
+                targets = []
+                self.top_branches.append(instr)
+            else:
+                targets = [instr["labels"][0] if cond else instr["labels"][1]]
+            self.cfg_work.extend((name, t) for t in targets)
+        elif op in ("jmp", "ret"):
+            self.cfg_work.extend((name, t) for t in successors(instr))
+        elif "dest" in instr:
+            self.lower(instr["dest"], evaluate(instr, self.value))
+
+    def is_const(self, var):
+        val = self.values[var]
+        return val is not TOP and val is not BOTTOM
+
+    def rewrite(self):
+        """Fold constants and delete unreachable blocks, in place."""
+        for name in list(self.blocks):
+            if name not in self.executable:
+                del self.blocks[name]
+
+        for block in self.blocks.values():
+            new_block = []
+            for instr in block:
+                op = instr["op"]
+                if op == "set":
+                    # Drop sets whose get was deleted or folded.
+                    target = instr["args"][0]
+                    if target not in self.get_block or self.is_const(target):
+                        continue
+                    if self.get_block[target] not in self.blocks:
+                        continue
+                elif op == "br" and self.is_const(instr["args"][0]):
+                    taken = instr["labels"][0 if self.values[instr["args"][0]] else 1]
+                    instr = {"op": "jmp", "labels": [taken]}
+                elif "dest" in instr and op not in ("call", "const"):
+                    if self.is_const(instr["dest"]):
+                        instr = {
+                            "op": "const",
+                            "dest": instr["dest"],
+                            "type": instr["type"],
+                            "value": self.values[instr["dest"]],
+                        }
+                new_block.append(instr)
+            block[:] = new_block
+
+
+def sccp(bril):
+    for func in bril["functions"]:
+        blocks = block_map(form_blocks(func["instrs"]))
+        if not blocks:
+            continue
+        add_terminators(blocks)
+        params = [arg["name"] for arg in func.get("args", [])]
+        SCCP(blocks, params).run().rewrite()
+        func["instrs"] = reassemble(blocks)
+    return bril
+
+
+if __name__ == "__main__":
+    program = json.load(sys.stdin)
+    print(json.dumps(sccp(program), indent=2, sort_keys=True))
@@ -0,0 +1,51 @@
+"""A function with no instructions must not hide the functions after
+it, whichever way a program is read and however its functions are run.
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PROGRAM = {
+    "functions": [
+        {"name": "empty", "instrs": []},
+        {
+            "name": "main",
+            "instrs": [
+                {"op": "const", "dest": "x", "type": "int", "value": 1},
+                {"op": "print", "args": ["x"]},
+            ],
+        },
+    ]
+}
+
+
+def run(script, *args):
+    p = subprocess.run(
+        [sys.executable, os.path.join(HERE, script)] + list(args),
+        input=json.dumps(PROGRAM), capture_output=True, text=True, cwd=HERE,
+    )
+    assert p.returncode == 0, p.stderr
+    return p.stdout
+
+
+@pytest.mark.parametrize("mode", ["dom", "front", "tree"])
+@pytest.mark.parametrize("flags", [[], ["--stream"], ["--jobs", "2"]])
+def test_dom(mode, flags):
+    out = run("dom.py", mode, *flags)
+    texts = json.loads("[" + out.replace("}\n{", "},\n{") + "]")
+    assert texts[0] == {}
+    assert list(texts[1]) == ["b1"]
+
+
+@pytest.mark.parametrize("flags", [[], ["--stream"], ["--jobs", "2"]])
+def test_to_ssa(flags):
+    funcs = json.loads(run("to_ssa.py", *flags))["functions"]
+    assert [f["name"] for f in funcs] == ["empty", "main"]
+    assert funcs[0]["instrs"] == []
+    assert {"label": "b1"} in funcs[1]["instrs"]
@@ -1,9 +1,11 @@
 import json
+import os
 import sys
 from collections import defaultdict
-from cfg import block_map, successors, add_terminators, add_entry, reassemble
-from form_blocks import form_blocks
-from dom import get_dom, dom_fronts, dom_tree
+from cfg import build_cfg, reassemble
+from dom import DominanceInfo, TASK4
+from stream import map_functions
+from cache import cache_arg, cached
 
 
 def ssa(bril_program):
@@ -19,14 +21,12 @@ def ssa(bril_program):
 
     for func in bril_program["functions"]:
         # (1) Build CFG and basic block info
-        basic_blocks = block_map(form_blocks(func["instrs"]))
-        add_entry(basic_blocks)
-        add_terminators(basic_blocks)
-
-        successors_map = {blk_name: successors(blk[-1]) for blk_name, blk in basic_blocks.items()}
-        dominators = get_dom(successors_map, list(basic_blocks.keys())[0])
-        dom_frontiers = dom_fronts(dominators, successors_map)
-        domtree = dom_tree(dominators)
+        basic_blocks, successors_map, _ = build_cfg(func["instrs"])
+        if not basic_blocks:
+            continue  # An empty function has nothing to rename.
+        dom_info = DominanceInfo(successors_map, list(basic_blocks.keys())[0])
+        dom_frontiers = dom_info.frontiers
+        domtree = dom_info.tree
 
         # (2) Record where each variable is defined
         var_def_blocks = defaultdict(set)
@@ -148,7 +148,25 @@ def ssa(bril_program):
     return bril_program
 
 
+def ssa_function(func):
+    return ssa({"functions": [func]})["functions"][0]
+
+
 if __name__ == "__main__":
-    program = json.load(sys.stdin)
-    ssa_program = ssa(program)
-    print(json.dumps(ssa_program, indent=2, sort_keys=True))
+    args = sys.argv[1:]
+    jobs = int(args[args.index("--jobs") + 1]) if "--jobs" in args else None
+    cache = cache_arg(args)
+    if jobs or cache or "--stream" in args:
+        # Each function is converted on its own, so only one needs to be
+        # in memory at a time, functions can go to separate workers, and
+        # unchanged ones can come from the cache.
+        transform = cached(ssa_function, "to_ssa", cache, os.path.dirname(os.path.abspath(__file__)),
+                           os.path.join(TASK4, "traversal.py"))
+        map_functions(transform, sys.stdin, sys.stdout, jobs)
+        print()
+        if cache:
+            cache.evict()
+    else:
+        program = json.load(sys.stdin)
+        ssa_program = ssa(program)
+        print(json.dumps(ssa_program, indent=2, sort_keys=True))